@@ -0,0 +1,134 @@
+import os
+import hmac
+import time
+import collections
+
+
+class CredentialHasher:
+    '''Keyed hash of passwords, with a key made per instance, so that
+    passwords can be recognized without being kept in memory.'''
+
+    def __init__(self):
+        self._secret = os.urandom(32)
+
+    def __call__(self, password):
+        return hmac.new(self._secret, password.encode('utf-8'),
+                        'sha256').digest()
+
+
+class TokenBuckets:
+    '''A token bucket per key, holding up to *burst* tokens and refilled
+    with *rate* tokens per second.
+
+    Keys whose bucket has filled up again are forgotten, and at most
+    *max_keys* buckets are kept, dropping the least recently used.
+    '''
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, time), least recently used first
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key):
+        'Take a token from the bucket of *key*; return False if it is empty.'
+        now = time.monotonic()
+        tokens, stamp = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        while self._buckets:
+            key, (tokens, stamp) = next(iter(self._buckets.items()))
+            full = tokens + (now - stamp) * self.rate >= self.burst
+            if not full and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AuthGuard:
+    '''Failed-login cache and login rate limits in front of the IMAP server.
+
+    When the IMAP server rejects a username and password, the rejection is
+    remembered for *failure_ttl* seconds, and the same username and
+    password are refused without contacting the server. Passwords are only
+    kept as a keyed hash with a per-process key.
+
+    Logins that would contact the IMAP server are limited per POP3 user and
+    per client address with token buckets, allowing *user_burst* and
+    *peer_burst* logins at once and *user_rate* and *peer_rate* per second
+    after that. A rate of 0 disables the limit.
+    '''
+
+    def __init__(self, failure_ttl=60, user_rate=0, user_burst=10,
+                 peer_rate=0, peer_burst=100, max_failures=100000):
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self._hash = CredentialHasher()
+        # (username, credential hash) -> (expiry time, response),
+        # oldest first
+        self._failures = collections.OrderedDict()
+        self.user_buckets = self.peer_buckets = None
+        if user_rate:
+            self.user_buckets = TokenBuckets(user_rate, user_burst)
+        if peer_rate:
+            self.peer_buckets = TokenBuckets(peer_rate, peer_burst)
+        self.refused_cached = self.refused_user = self.refused_peer = 0
+        self.failed = self.succeeded = 0
+
+    def _key(self, username, password):
+        return username, self._hash(password)
+
+    def check(self, username, password, peer):
+        '''Return the -ERR response refusing the login, or None to allow it.'''
+        if self._failures:
+            now = time.monotonic()
+            while self._failures:
+                expiry, status = next(iter(self._failures.values()))
+                if expiry > now:
+                    break
+                self._failures.popitem(last=False)
+            failure = self._failures.get(self._key(username, password))
+            if failure is not None:
+                self.refused_cached += 1
+                return failure[1]
+        if self.peer_buckets is not None and not self.peer_buckets.take(peer):
+            self.refused_peer += 1
+            return ('-ERR [SYS/TEMP] too many logins from your address, ' +
+                    'try again later')
+        if self.user_buckets is not None and not self.user_buckets.take(
+                username):
+            self.refused_user += 1
+            return '-ERR [SYS/TEMP] too many logins, try again later'
+        return None
+
+    def login_failed(self, username, password, status):
+        '''Remember that the IMAP server rejected *username* and *password*,
+        to refuse them with the -ERR response *status*.'''
+        self.failed += 1
+        if not self.failure_ttl:
+            return
+        key = self._key(username, password)
+        self._failures.pop(key, None)
+        self._failures[key] = (time.monotonic() + self.failure_ttl, status)
+        while len(self._failures) > self.max_failures:
+            self._failures.popitem(last=False)
+
+    def login_succeeded(self):
+        self.succeeded += 1
+
+    def stats(self):
+        return dict(cached_failures=len(self._failures),
+                    refused_cached=self.refused_cached,
+                    refused_user=self.refused_user,
+                    refused_peer=self.refused_peer,
+                    failed=self.failed, succeeded=self.succeeded)
@@ -1,18 +1,61 @@
 import os
 import pwd
+import time
+import signal
+import socket
 import asyncio
+import logging
 import threading
 
 from aiopopd.pop import Pop3, log
 
 
+LOOPS = ('asyncio', 'uvloop')
+PROFILES = ('production', 'debug')
+
+
+def new_event_loop(name='asyncio'):
+    'Return a new event loop of the implementation *name* in LOOPS.'
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            raise ValueError('uvloop is not installed')
+        return uvloop.new_event_loop()
+    if name != 'asyncio':
+        raise ValueError('unknown event loop %r' % (name,))
+    return asyncio.new_event_loop()
+
+
+def configure_loop(loop, profile='production'):
+    '''Apply the *profile* in PROFILES to *loop*.
+
+    "debug" turns on asyncio debug mode, which checks for unawaited
+    coroutines and calls from other threads and logs callbacks slower than
+    50 ms, at a considerable cost per callback. "production" turns it off.
+    '''
+    if profile not in PROFILES:
+        raise ValueError('unknown loop profile %r' % (profile,))
+    loop.set_debug(profile == 'debug')
+    if profile == 'debug':
+        loop.slow_callback_duration = 0.05
+
+
+def drop_privileges():
+    'Switch to the user nobody.'
+    os.setuid(pwd.getpwnam('nobody').pw_uid)
+
+
 class Controller:
     def __init__(self, handler, loop=None, hostname=None, port=1100, *,
-                 ready_timeout=1.0, ssl_context=None, setuid=False):
+                 ready_timeout=1.0, ssl_context=None, setuid=False,
+                 sock=None):
         self.handler = handler
         self.hostname = '::1' if hostname is None else hostname
         self.port = port
         self.ssl_context = ssl_context
+        # Listening socket to serve on instead of binding hostname:port
+        self.sock = sock
         self.loop = asyncio.new_event_loop() if loop is None else loop
         self.server = None
         self._thread = None
@@ -27,16 +70,18 @@ class Controller:
 
     def drop_privileges(self):
         if self.setuid:
-            nobody = pwd.getpwnam('nobody').pw_uid
-            os.setuid(nobody)
+            drop_privileges()
 
     def _run(self, ready_event):
         asyncio.set_event_loop(self.loop)
+        if self.sock is not None:
+            address = dict(sock=self.sock)
+        else:
+            address = dict(host=self.hostname, port=self.port)
         try:
             self.server = self.loop.run_until_complete(
                 self.loop.create_server(
-                    self.factory, host=self.hostname, port=self.port,
-                    ssl=self.ssl_context))
+                    self.factory, ssl=self.ssl_context, **address))
             self.drop_privileges()
         except Exception as error:
             self._thread_exception = error
@@ -63,7 +108,7 @@ class Controller:
 
     def _stop(self):
         self.loop.stop()
-        for task in asyncio.Task.all_tasks(self.loop):
+        for task in asyncio.all_tasks(self.loop):
             task.cancel()
 
     def stop(self):
@@ -79,3 +124,108 @@ class Controller:
 
     def log_stop(self):
         log.info("POP3 server stopping")
+
+
+def reuse_port_sockets(hostname, port, count):
+    """Return *count* sockets listening on the same address.
+
+    With SO_REUSEPORT, the kernel spreads new connections over the sockets,
+    so each worker process accepts on a socket of its own. A single socket
+    is bound without it.
+    """
+    family, type, proto, _, address = socket.getaddrinfo(
+        hostname, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(family, type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if count > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(100)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+
+class Prefork:
+    """Run one worker process per listening socket and keep them running.
+
+    Each worker calls *run_worker* with its socket, which should serve until
+    KeyboardInterrupt; SIGINT and SIGTERM raise it in the workers. The
+    sockets are bound before privileges are dropped, and a worker that
+    exits while the server is not stopping is started again on the same
+    socket. SIGINT or SIGTERM to the parent stops all workers.
+    """
+
+    # Seconds to wait before restarting a worker that exited
+    restart_delay = 1.0
+
+    def __init__(self, sockets, run_worker, *, setuid=False):
+        self.sockets = sockets
+        self.run_worker = run_worker
+        self.setuid = setuid
+        self.workers = {}
+        self._stopping = False
+
+    drop_privileges = Controller.drop_privileges
+
+    def _spawn(self, i):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = i
+            log.info('Started worker %s (pid %s)', i, pid)
+            if self._stopping:
+                # Signalled while forking
+                os.kill(pid, signal.SIGTERM)
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            for j, sock in enumerate(self.sockets):
+                if j != i:
+                    sock.close()
+            self.run_worker(self.sockets[i])
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            log.exception('Worker %s failed', i)
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _signal(self, signum, frame):
+        self.stop()
+
+    def stop(self):
+        self._stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.drop_privileges()
+        signal.signal(signal.SIGINT, self._signal)
+        signal.signal(signal.SIGTERM, self._signal)
+        for i in range(len(self.sockets)):
+            self._spawn(i)
+        while self.workers:
+            pid, status = os.wait()
+            i = self.workers.pop(pid, None)
+            if i is None or self._stopping:
+                continue
+            if os.WIFSIGNALED(status):
+                how = 'killed by signal %s' % os.WTERMSIG(status)
+            else:
+                how = 'exited with status %s' % os.WEXITSTATUS(status)
+            log.warning('Worker %s (pid %s) %s; restarting', i, pid, how)
+            time.sleep(self.restart_delay)
+            if not self._stopping:
+                self._spawn(i)
+        for sock in self.sockets:
+            sock.close()
+        log.info('All workers stopped')
@@ -0,0 +1,103 @@
+import re
+import asyncio
+import collections
+
+from aiopopd.pop import log
+
+
+# The length of a partial fetch such as BODY.PEEK[]<0.262144>
+_PARTIAL = re.compile(r'<\d+\.(\d+)>$')
+
+
+class DeadlineExceeded(Exception):
+    'The IMAP server did not answer in time, and the connection was closed.'
+
+
+class Deadlines:
+    '''Seconds an IMAP server has to complete each kind of command.
+
+    *connect*, *login* and *select* apply to connecting, LOGIN and SELECT,
+    and *command* to every other command. A FETCH also gets *fetch_per_mb*
+    seconds per megabyte of message data it returns. None means no
+    deadline. The thread backend only connects when it sends LOGIN, so
+    there the login deadline covers connecting too.
+    '''
+
+    def __init__(self, connect=None, login=None, select=None, command=None,
+                 fetch_per_mb=None):
+        self.connect = connect
+        self.login = login
+        self.select = select
+        self.command = command
+        self.fetch_per_mb = fetch_per_mb
+        # Command name -> deadlines missed
+        self.missed = collections.Counter()
+
+    def timeout(self, name, size=0):
+        'Return the deadline for the backend method *name*, or None.'
+        if name == 'connect':
+            return self.connect
+        if name == 'login':
+            return self.login
+        if name == 'select_folder':
+            return self.select
+        if name == 'fetch' and size and self.fetch_per_mb is not None:
+            return (self.command or 0) + self.fetch_per_mb * size / 1e6
+        return self.command
+
+    def stats(self):
+        return dict(missed=sum(self.missed.values()), **{
+            'missed_' + name: count for name, count in self.missed.items()})
+
+
+class TimedBackend:
+    '''An IMAP backend that is aborted when a command misses its deadline.
+
+    fetch_sized() is fetch() given the expected number of bytes, for a
+    deadline that grows with the message; fetch() reads the size of partial
+    fetches from the fetch items.
+    '''
+
+    # idle_check has a timeout argument of its own
+    UNLIMITED = frozenset(['idle_check'])
+
+    def __init__(self, backend, deadlines, host):
+        self._backend = backend
+        self._deadlines = deadlines
+        self._host = host
+
+    async def _run(self, name, coro, size=0):
+        timeout = self._deadlines.timeout(name, size)
+        if timeout is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            self._deadlines.missed[name] += 1
+            log.warning('%s IMAP %s missed its deadline of %.1f s; '
+                        'closing the connection', self._host, name, timeout)
+            self._backend.abort()
+            raise DeadlineExceeded('IMAP server %s did not answer in time' %
+                                   self._host)
+
+    async def fetch(self, messages, data, modifiers=None):
+        size = 0
+        for item in data:
+            mo = _PARTIAL.search(item)
+            if mo is not None:
+                size += int(mo.group(1))
+        return await self.fetch_sized(messages, data, size, modifiers)
+
+    async def fetch_sized(self, messages, data, size, modifiers=None):
+        return await self._run('fetch', self._backend.fetch(
+            messages, data, modifiers), size)
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name in self.UNLIMITED or not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def timed(*args, **kwargs):
+            return await self._run(name, attr(*args, **kwargs))
+
+        return timed
@@ -0,0 +1,70 @@
+CHUNK_SIZE = 64 * 1024
+TERMINATOR = b'.\r\n'
+
+
+class MultilineEncoder:
+    '''Encode message data as the body of a POP3 multi-line response.
+
+    Data may be fed in arbitrary pieces. The output has every line ending
+    normalized to CRLF (IMAP servers occasionally hand out bare LF), every
+    line starting with "." dot-stuffed, and is produced in chunks of about
+    *chunk_size* bytes. Chunks that need no rewriting are returned as
+    memoryview slices of the input without copying.
+    '''
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # Whether the next input byte starts a line
+        self._bol = True
+        # Whether the last input byte was a CR
+        self._cr = False
+
+    def feed(self, data):
+        'Return an iterator over the encoded chunks of *data*.'
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        view = memoryview(data)
+        pos, n = 0, len(data)
+        while pos < n:
+            end = min(pos + self.chunk_size, n)
+            lf = data.count(b'\n', pos, end)
+            bare = lf and lf != (data.count(b'\r\n', pos, end) +
+                                 (self._cr and data[pos] == 10))
+            stuff = ((self._bol and data[pos] == 46) or
+                     data.find(b'\n.', pos, end) != -1)
+            if bare or stuff:
+                yield self._rewrite(data[pos:end], bare)
+            else:
+                yield view[pos:end]
+            self._cr = data[end - 1] == 13
+            self._bol = data[end - 1] == 10
+            pos = end
+
+    def _rewrite(self, piece, bare):
+        head = b''
+        bol = self._bol
+        if self._cr and piece[:1] == b'\n':
+            # Second half of a CRLF that was split between two chunks
+            head, piece, bol = b'\n', piece[1:], True
+        if bare:
+            piece = piece.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        piece = piece.replace(b'\n.', b'\n..')
+        if bol and piece[:1] == b'.':
+            piece = b'.' + piece
+        return head + piece
+
+    def finish(self):
+        'Return the bytes that terminate the multi-line response.'
+        if self._cr:
+            tail = b'\n'
+        elif not self._bol:
+            tail = b'\r\n'
+        else:
+            tail = b''
+        self._bol, self._cr = True, False
+        return tail + TERMINATOR
+
+
+def encode_lines(lines):
+    'Join a list of lines (without line endings) into CRLF-terminated data.'
+    return b''.join(line + b'\r\n' for line in lines)
@@ -1,38 +1,188 @@
+import ast
 import asyncio
 from aiopopd.imap_backend import ImapBackend
+from aiopopd.imap_async import AsyncImapBackend, ImapAbort
+from aiopopd.index import SEEN, sync_index
+from aiopopd.messages import MessageTable
+from aiopopd.prefetch import Prefetcher
+from aiopopd.scheduler import HostBusy
+from aiopopd.deadline import Deadlines, DeadlineExceeded, TimedBackend
 from aiopopd.pop import log
 
 
-class Message:
-    def __init__(self, uid, deleted, size):
-        self.uid = uid
-        self.deleted = deleted
-        self.size = size
+BACKENDS = {
+    'thread': ImapBackend,
+    'asyncio': AsyncImapBackend,
+}
 
 
-SEEN = br'\Seen'
+def uid_set(uids):
+    'Return an IMAP message set like "1:4,7,9:10" for the sorted *uids*.'
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join('%d' % a if a == b else '%d:%d' % (a, b)
+                    for a, b in ranges)
+
+
+class LoginFailed(Exception):
+    '''The IMAP server rejected the username or password.
+
+    The message is the text of the server's reply, as given by the login
+    error *error* of either backend.
+    '''
+
+    def __init__(self, error):
+        text = error.args[0] if error.args else ''
+        if isinstance(text, str) and text[:2] in ('b"', "b'"):
+            # IMAPClient's LoginError holds the repr of the reply
+            try:
+                text = ast.literal_eval(text)
+            except (ValueError, SyntaxError):
+                pass
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        super().__init__(text)
 
 
 class ImapHandler:
-    def __init__(self, *, loop=None):
+    # IMAP SEARCH criteria selecting the messages offered to the client
+    search_criteria = 'UNSEEN'
+    # Bytes of prefetched messages one session may hold
+    prefetch_session_bytes = 32 * 1024 * 1024
+    # Messages larger than this are sent while they are fetched, in partial
+    # fetches of stream_chunk_size bytes, instead of being held in memory.
+    # 0 disables streaming.
+    stream_threshold = 1024 * 1024
+    stream_chunk_size = 256 * 1024
+    # Failures of the IMAP server or its connection, answered with
+    # -ERR [SYS/TEMP] so the client tries again later
+    temporary_errors = (HostBusy, DeadlineExceeded, ImapAbort)
+
+    def __init__(self, *, loop=None, backend_class=ImapBackend,
+                 index_store=None, search_criteria=None, prefetch_depth=0,
+                 prefetch_session_bytes=None, prefetch_budget=None,
+                 stream_threshold=None, stream_chunk_size=None, spool=None,
+                 backend_pool=None, auth_guard=None, scheduler=None,
+                 deadlines=None):
         self.loop = loop or asyncio.get_event_loop()
+        self.backend_class = backend_class
+        self.index_store = index_store
+        if search_criteria is not None:
+            self.search_criteria = search_criteria
+        if prefetch_session_bytes is not None:
+            self.prefetch_session_bytes = prefetch_session_bytes
+        if stream_threshold is not None:
+            self.stream_threshold = stream_threshold
+        if stream_chunk_size is not None:
+            self.stream_chunk_size = stream_chunk_size
+        self.spool = spool
+        self.backend_pool = backend_pool
+        self.auth_guard = auth_guard
+        self.scheduler = scheduler
+        # Without deadlines, TimedBackend only passes the calls on
+        self.deadlines = Deadlines() if deadlines is None else deadlines
+        self.pool_key = None
+        # MailboxIndex of the selected INBOX kept current by the pool
+        self.warm_index = None
+        self.prefetcher = None
+        if prefetch_depth:
+            self.prefetcher = Prefetcher(
+                self.fetch_body, prefetch_depth,
+                self.prefetch_session_bytes, prefetch_budget,
+                max_size=self.stream_threshold or None,
+                is_cached=self.is_spooled if spool is not None else None)
         self.backend = None
+        self.account = None
+        self.index = None
+        self.uidvalidity = None
 
     async def get_backend(self, username, password):
         raise NotImplementedError
 
+    async def open_backend(self, host, port, ssl, username, password):
+        if self.backend_pool is not None:
+            key = self.backend_pool.key(host, port, ssl, username, password)
+            pooled = await self.backend_pool.acquire(key)
+            if pooled is not None:
+                backend, self.warm_index = pooled
+                self.account = (username, host)
+                self.pool_key = key
+                return backend
+        backend = self.backend_class(loop=self.loop, host=host, port=port,
+                                     ssl=ssl)
+        backend = TimedBackend(backend, self.deadlines, host)
+        if self.scheduler is not None:
+            if (self.backend_pool is not None and
+                    self.scheduler.connections_full(host)):
+                # Rather close a connection kept for someone else than wait
+                self.backend_pool.close_idle(host)
+            backend = self.scheduler.wrap(backend, host, username)
+        try:
+            await backend.connect()
+            await backend.login(username, password)
+            if self.index_store is not None:
+                await self.enable_qresync(backend)
+        except backend.login_errors as exn:
+            backend.connection_lost()
+            raise LoginFailed(exn)
+        except BaseException:
+            backend.connection_lost()
+            raise
+        self.account = (username, host)
+        if self.backend_pool is not None:
+            self.pool_key = key
+        return backend
+
+    async def enable_qresync(self, backend):
+        # Must come before SELECT. Index syncs then learn of expunged
+        # messages from FETCH CHANGEDSINCE instead of a full SEARCH.
+        if await backend.has_capability('QRESYNC'):
+            await backend.enable('QRESYNC')
+
     def connection_lost(self):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
         if self.backend:
             self.backend.connection_lost()
 
+    async def handle_exception(self, error):
+        if isinstance(error, self.temporary_errors):
+            log.warning('IMAP connection failed: %s', error)
+            return '-ERR [SYS/TEMP] %s' % error
+        log.exception('POP3 session exception')
+        return '-ERR Error: ({}) {}'.format(error.__class__.__name__, error)
+
     async def handle_PASS(self, server, username, password):
+        guard = self.auth_guard
+        if guard is not None:
+            peer = server.peer[0] if isinstance(server.peer, tuple) else \
+                server.peer
+            refusal = guard.check(username, password, peer)
+            if refusal is not None:
+                server.username = None
+                return refusal
         try:
             self.backend = await self.get_backend(username, password)
+        except LoginFailed as exn:
+            status = '-ERR [AUTH] %s' % exn
+            if guard is not None:
+                guard.login_failed(username, password, status)
+            server.username = None
+            return status
+        except self.temporary_errors as exn:
+            server.username = None
+            return '-ERR [SYS/TEMP] %s' % exn
         except Exception as exn:
             log.exception('%s %s Exception in get_backend',
                           server.peer_str, username)
             server.username = None
             return '-ERR %s' % exn
+        if guard is not None:
+            guard.login_succeeded()
         server.password = password
         server.state = 'TRANSACTION'
         self.messages = await self.list_messages()
@@ -42,76 +192,235 @@ class ImapHandler:
         return '+OK remote login successful'
 
     async def list_messages(self):
-        n_messages = await self.backend.select_folder('INBOX')
-        if n_messages == 0:
-            log.warning('%s %r SELECT returned 0 meaning no messages in inbox',
-                        server.peer_str, username)
-            return []
-        message_ids = await self.backend.search()
-        params = [
-            'FLAGS', 'RFC822.SIZE',
-            # 'BODY.PEEK[HEADER.FIELDS (Date From To Cc Subject ' +
-            # 'Message-ID References In-Reply-To)]',
-        ]
-        data = await self.backend.fetch(message_ids, params)
-
-        def is_deleted(imap_flags):
-            return SEEN in imap_flags
-
-        def parse(message_key, message_value):
-            message_value.pop(b'SEQ', None)
-            deleted = is_deleted(message_value.pop(b'FLAGS'))
-            size = message_value.pop(b'RFC822.SIZE')
-            return Message(message_key, deleted, size)
-
-        all_messages = (parse(k, v) for k, v in data.items())
-        return [m for m in all_messages if not m.deleted]
+        if self.warm_index is not None:
+            self.index, self.warm_index = self.warm_index, None
+            self.uidvalidity = self.index.uidvalidity
+            return await self.index_messages()
+        info = await self.backend.select_folder('INBOX')
+        self.uidvalidity = info.get(b'UIDVALIDITY')
+        if self.index_store is not None and self.account is not None:
+            return await self.list_messages_indexed(info)
+        if info.get(b'EXISTS') == 0:
+            return MessageTable()
+        # Let the server pick the messages to offer, and only ask for the
+        # sizes of those.
+        uids = sorted(await self.backend.search(self.search_criteria))
+        if not uids:
+            return MessageTable()
+        data = await self.backend.fetch(uid_set(uids), ['RFC822.SIZE'])
+        uids = [uid for uid in uids if uid in data]
+        return MessageTable(uids, [data[uid][b'RFC822.SIZE'] for uid in uids])
+
+    def index_key(self, folder='INBOX'):
+        return self.account + (folder,)
+
+    async def list_messages_indexed(self, info):
+        key = self.index_key()
+        index = await self.index_store.load(key)
+        if index is None:
+            log.info('%r No index; scanning the whole folder', key)
+        self.index = await sync_index(self.backend, index, info)
+        self.index_store.save_soon(key, self.index)
+        return await self.index_messages()
+
+    async def index_messages(self):
+        unseen = self.index.unseen()
+        if self.search_criteria != ImapHandler.search_criteria:
+            selected = set(await self.backend.search(self.search_criteria))
+            unseen = [(uid, size) for uid, size in unseen if uid in selected]
+        return MessageTable([uid for uid, size in unseen],
+                            [size for uid, size in unseen])
 
     async def handle_QUIT(self, server):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
         if server.state == 'TRANSACTION':
-            to_delete = [m.uid for m in self.messages if m.deleted]
+            to_delete = self.messages.deleted_uids()
             if to_delete:
                 log.info('%s %s Delete %s message(s)',
                          server.peer_str, server.username, len(to_delete))
-                await self.backend.add_flags(to_delete, [SEEN])
+                await self.backend.add_flags(uid_set(to_delete), [SEEN],
+                                             silent=True)
+                if self.index is not None:
+                    for uid in to_delete:
+                        self.index.set_seen(uid, True)
+                    self.index_store.save_soon(self.index_key(), self.index)
         if self.backend is not None:
-            await self.backend.disconnect()
+            # Sessions waiting for a connection to the host get this one's
+            # slot rather than the pool
+            wanted = (self.scheduler is not None and
+                      self.scheduler.connections_wanted(self.account[1]))
+            if self.pool_key is not None and not wanted:
+                self.backend_pool.release(self.pool_key, self.backend,
+                                          self.index)
+            else:
+                await self.backend.disconnect()
             self.backend = None
         return '+OK Bye'
 
     async def handle_STAT(self, server):
-        n = sum(1 for m in self.messages if not m.deleted)
-        size = sum(m.size for m in self.messages if not m.deleted)
-        return '+OK %s %s' % (n, size)
+        return '+OK %s %s' % (self.messages.count, self.messages.octets)
 
     async def handle_LIST(self, server, n):
-        m = self.messages[n-1]
-        if not m.deleted:
-            return m.size
+        if not self.messages.is_deleted(n):
+            return self.messages.size(n)
 
     async def handle_UIDL(self, server, n):
-        m = self.messages[n-1]
-        if not m.deleted:
-            return m.uid
+        if not self.messages.is_deleted(n):
+            return self.messages.uid(n)
+
+    async def handle_LIST_all(self, server):
+        return ((n, size) for n, uid, size in self.messages.live())
+
+    async def handle_UIDL_all(self, server):
+        return ((n, uid) for n, uid, size in self.messages.live())
 
     async def handle_RETR(self, server, n):
-        m = self.messages[n-1]
-        if m.deleted:
+        if self.messages.is_deleted(n):
+            return '-ERR message deleted'
+        uid = self.messages.uid(n)
+        size = self.messages.size(n)
+        key = self.spool_key(uid)
+        fp = None if key is None else self.spool.open(key)
+        if fp is not None:
+            if self.prefetcher is not None:
+                self.prefetcher.skip(self.messages, n)
+            with fp:
+                await server.push_file('+OK message follows', fp)
+            return
+        if self.stream_threshold and size > self.stream_threshold:
+            if self.prefetcher is not None:
+                self.prefetcher.skip(self.messages, n)
+            chunks = self.stream_body(uid, size)
+            writer = None if key is None else self.spool.writer(key, size)
+            stream = chunks if writer is None else writer.tee(chunks)
+            try:
+                await server.push_multi_stream('+OK message follows', stream)
+            finally:
+                # If the client went away, finish the generators now rather
+                # than when they are collected
+                await stream.aclose()
+                await chunks.aclose()
+                if writer is not None:
+                    await writer.commit()
+            return
+        if self.prefetcher is not None:
+            body = await self.prefetcher.retrieve(self.messages, n)
+        else:
+            body = await self.fetch_body(uid, size)
+        if key is None:
+            await server.push_multi('+OK message follows', body)
+        else:
+            # Write the spool file while the message is sent
+            store = asyncio.ensure_future(self.spool.store(key, body))
+            try:
+                await server.push_multi('+OK message follows', body)
+            finally:
+                await store
+
+    def spool_key(self, uid):
+        if (self.spool is None or self.account is None or
+                self.uidvalidity is None):
+            return None
+        username, host = self.account
+        return (host, username, self.uidvalidity, uid)
+
+    def is_spooled(self, uid):
+        key = self.spool_key(uid)
+        return key is not None and key in self.spool
+
+    async def fetch_body(self, uid, size=0):
+        # A backend from open_backend gives slow servers time by size
+        fetch_sized = getattr(self.backend, 'fetch_sized', None)
+        if fetch_sized is None:
+            result = await self.backend.fetch([uid], ['RFC822'])
+        else:
+            result = await fetch_sized([uid], ['RFC822'], size)
+        data, = result.values()
+        return data[b'RFC822']
+
+    @staticmethod
+    def body_section(data, section):
+        # The server answers BODY.PEEK[TEXT]<0.100> with BODY[TEXT]<0>
+        prefix = b'BODY[%s]' % section
+        for key, value in data.items():
+            if key.startswith(prefix):
+                return value or b''
+        raise ValueError('No %s in FETCH response' % prefix.decode())
+
+    async def fetch_partial(self, uid, offset, length):
+        section = 'BODY.PEEK[]<%d.%d>' % (offset, length)
+        data, = (await self.backend.fetch([uid], [section])).values()
+        return self.body_section(data, b'')
+
+    async def stream_body(self, uid, size):
+        '''Yield the message with the given *uid* in chunks.
+
+        The next chunk is fetched while the current one is sent, so at most
+        two chunks are held at a time. Chunks are fetched until one comes
+        back short, as servers may under-report the RFC822.SIZE given as
+        *size*.
+        '''
+        chunk_size = self.stream_chunk_size
+        offset = 0
+        pending = asyncio.ensure_future(
+            self.fetch_partial(uid, offset, chunk_size))
+        try:
+            while pending is not None:
+                chunk = await pending
+                offset += len(chunk)
+                pending = None
+                if len(chunk) == chunk_size:
+                    pending = asyncio.ensure_future(
+                        self.fetch_partial(uid, offset, chunk_size))
+                if chunk:
+                    yield chunk
+        finally:
+            if pending is not None:
+                # Let the FETCH finish rather than cut it off halfway
+                pending.add_done_callback(
+                    lambda f: f.cancelled() or f.exception())
+
+    async def handle_TOP(self, server, n, lines):
+        if self.messages.is_deleted(n):
             return '-ERR message deleted'
-        params = ['RFC822']
-        data, = (await self.backend.fetch([m.uid], params)).values()
-        await server.push_multi('+OK message follows', data[b'RFC822'])
+        uid = self.messages.uid(n)
+        size = self.messages.size(n)
+        # Guess the length of the first lines of the body, and fetch more
+        # of it, twice as much each time, until enough lines are found.
+        length = min(max(lines * 100, 1024), self.stream_chunk_size)
+        items = ['BODY.PEEK[HEADER]']
+        if lines:
+            items.append('BODY.PEEK[TEXT]<0.%d>' % length)
+        data, = (await self.backend.fetch([uid], items)).values()
+        header = self.body_section(data, b'HEADER')
+        text = self.body_section(data, b'TEXT') if lines else b''
+        found = text.count(b'\n')
+        more = text
+        while (found < lines and len(more) == length and
+               len(header) + len(text) < size):
+            length = min(2 * length, self.stream_chunk_size)
+            section = 'BODY.PEEK[TEXT]<%d.%d>' % (len(text), length)
+            data, = (await self.backend.fetch([uid], [section])).values()
+            more = self.body_section(data, b'TEXT')
+            found += more.count(b'\n')
+            text += more
+        end = -1
+        for i in range(lines):
+            end = text.find(b'\n', end + 1)
+            if end == -1:
+                break
+        else:
+            text = text[:end + 1]
+        await server.push_multi('+OK top of message follows', header + text)
 
     async def handle_DELE(self, server, n):
-        m = self.messages[n-1]
-        if m.deleted:
+        if not self.messages.delete(n):
             return '-ERR message already deleted'
-        m.deleted = True
         return '+OK deleted'
 
     async def handle_RSET(self, server):
-        for m in self.messages:
-            m.deleted = False
+        self.messages.reset()
         return '+OK'
 
 
@@ -123,8 +432,5 @@ class ImapHandlerFixed(ImapHandler):
         self.ssl = ssl
 
     async def get_backend(self, username, password):
-        backend = ImapBackend(loop=self.loop, host=self.hostname,
-                              port=self.port, ssl=self.ssl)
-        await backend.connect()
-        await backend.login(username, password)
-        return backend
+        return await self.open_backend(self.hostname, self.port, self.ssl,
+                                       username, password)
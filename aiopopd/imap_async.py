@@ -0,0 +1,462 @@
+import re
+import ssl
+import asyncio
+import itertools
+
+from aiopopd.index import uid_ranges
+
+
+class ImapError(Exception):
+    'An IMAP command failed; text is the reply of the server, if any.'
+
+    def __init__(self, message, text=None):
+        super().__init__(message)
+        self.text = text
+
+
+class ImapAbort(ImapError):
+    pass
+
+
+class LoginError(ImapError):
+    pass
+
+
+_LITERAL = re.compile(rb'\{(\d+)\+?\}\r?\n$')
+_TOKEN = re.compile(rb'''[ ]*(?:
+    (?P<paren>[()])
+  | "(?P<quoted>(?:[^"\\]|\\.)*)"
+  | (?P<atom>[^ ()"\[\]]*\[[^\]]*\](?:<[0-9]+>)?|[^ ()"]+)
+)''', re.X)
+_QUOTED_SPECIAL = re.compile(rb'\\(.)')
+_RESP_CODE = re.compile(rb'\[(?P<key>[A-Z-]+)(?: (?P<data>[^\]]*))?\]')
+_NEEDS_LITERAL = re.compile(rb'[\r\n\x00\x80-\xff]')
+_INT_CODES = (b'UIDVALIDITY', b'UIDNEXT', b'HIGHESTMODSEQ', b'UNSEEN')
+
+
+class _Literal(bytes):
+    pass
+
+
+def _tokens(parts):
+    # parts alternates text fragments and literals, starting and ending
+    # with a text fragment.
+    for i, part in enumerate(parts):
+        if i % 2:
+            yield 'literal', part
+            continue
+        for mo in _TOKEN.finditer(part):
+            kind = mo.lastgroup
+            yield kind, mo.group(kind)
+
+
+def _parse_values(tokens):
+    stack = [[]]
+    for kind, value in tokens:
+        if kind == 'paren':
+            if value == b'(':
+                stack.append([])
+            else:
+                if len(stack) == 1:
+                    raise ImapError('unbalanced parenthesis')
+                inner = tuple(stack.pop())
+                stack[-1].append(inner)
+        elif kind == 'quoted':
+            stack[-1].append(_QUOTED_SPECIAL.sub(rb'\1', value))
+        elif kind == 'literal':
+            stack[-1].append(bytes(value))
+        elif value.isdigit():
+            stack[-1].append(int(value))
+        elif value.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(value)
+    if len(stack) != 1:
+        raise ImapError('unbalanced parenthesis')
+    return stack[0]
+
+
+def _to_bytes(s):
+    return s if isinstance(s, bytes) else str(s).encode('utf-8')
+
+
+def _quote(s):
+    s = _to_bytes(s)
+    if _NEEDS_LITERAL.search(s):
+        return _Literal(s)
+    return b'"' + s.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def _message_set(messages):
+    if isinstance(messages, (str, bytes, int)):
+        return _to_bytes(messages)
+    return b','.join(b'%d' % m for m in messages)
+
+
+def _item_list(items):
+    if isinstance(items, (str, bytes)):
+        items = [items]
+    return b'(' + b' '.join(_to_bytes(i).upper() for i in items) + b')'
+
+
+def _criteria(criteria):
+    if isinstance(criteria, (str, bytes)):
+        return _to_bytes(criteria)
+    return b' '.join(_to_bytes(c) for c in criteria)
+
+
+class AsyncImapBackend:
+    '''IMAP client running directly on the event loop.
+
+    Offers the subset of the ImapBackend method surface that aiopopd uses,
+    with the same argument conventions and return values as IMAPClient in
+    UID mode, but without a thread or a pipe per connection.
+    '''
+
+    # Raised by login() when the server rejects the credentials
+    login_errors = (LoginError,)
+
+    def __init__(self, loop, host, port, ssl, metrics=None):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self._ssl = ssl
+        # Records the round trip of each command
+        self._metrics = metrics
+        self._reader = self._writer = None
+        self._lock = asyncio.Lock()
+        self._tags = itertools.count(1)
+        self._capabilities = None
+        self._idle_tag = None
+        # Capabilities turned on with enable(), as upper case bytes
+        self.enabled = frozenset()
+
+    def connection_lost(self):
+        self._close()
+
+    # Commands run on the caller's task, so there is nothing to interrupt
+    abort = connection_lost
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if self._ssl else None
+        self._reader, self._writer = await asyncio.open_connection(
+            self._host, self._port, ssl=ssl_context)
+        greeting = await self._read_response()
+        if not greeting[0].startswith((b'* OK', b'* PREAUTH')):
+            self._close()
+            raise ImapAbort('unexpected greeting %r' % greeting[0])
+        self._update_capabilities(greeting[0])
+
+    async def disconnect(self):
+        try:
+            await self.logout()
+        finally:
+            self._close()
+
+    async def _read_line(self):
+        if self._reader is None:
+            raise ImapAbort('connection is closed')
+        return await self._reader.readline()
+
+    async def _read_response(self, line=None):
+        # *line* is the first line of the response, if already read
+        if self._reader is None:
+            raise ImapAbort('connection is closed')
+        parts = []
+        while True:
+            if line is None:
+                line = await self._reader.readline()
+            if not line:
+                self._close()
+                raise ImapAbort('connection closed by server')
+            mo = _LITERAL.search(line)
+            if mo is None:
+                parts.append(line.rstrip(b'\r\n'))
+                return parts
+            parts.append(line[:mo.start()])
+            parts.append(await self._reader.readexactly(int(mo.group(1))))
+            line = None
+
+    def _parse_untagged(self, parts):
+        text = parts[0][2:]
+        status = text.split(b' ', 1)[0].upper()
+        if status in (b'OK', b'NO', b'BAD', b'BYE', b'PREAUTH'):
+            self._update_capabilities(text)
+            return tuple(text.split(b' ', 1))
+        return tuple(_parse_values(_tokens([text] + parts[1:])))
+
+    def _update_capabilities(self, text):
+        mo = _RESP_CODE.search(text)
+        if mo and mo.group('key') == b'CAPABILITY':
+            self._capabilities = tuple(mo.group('data').upper().split())
+
+    async def _send(self, args):
+        line = b''
+        for arg in args:
+            if isinstance(arg, _Literal):
+                self._writer.write(line + b'{%d}\r\n' % len(arg))
+                await self._writer.drain()
+                while True:
+                    parts = await self._read_response()
+                    if parts[0].startswith(b'+'):
+                        break
+                    if not parts[0].startswith(b'* '):
+                        raise ImapError('literal rejected: %r' % parts[0])
+                line = bytes(arg)
+            else:
+                line += (b' ' if line else b'') + arg
+        self._writer.write(line + b'\r\n')
+        await self._writer.drain()
+
+    async def _command(self, name, *args, command=None):
+        # *command* names the command in metrics, if not *name*
+        if self._idle_tag is not None:
+            raise ImapError('%s not allowed in IDLE mode' % name)
+        async with self._lock:
+            tag = b'A%d' % next(self._tags)
+            if self._metrics is None:
+                await self._send((tag, name.encode('ascii')) + args)
+                return await self._wait_tagged(tag, name)
+            histogram = self._metrics.imap_call((command or name).lower())
+            start = self._loop.time()
+            try:
+                await self._send((tag, name.encode('ascii')) + args)
+                return await self._wait_tagged(tag, name)
+            finally:
+                histogram.observe(self._loop.time() - start)
+
+    async def _wait_tagged(self, tag, name):
+        untagged = []
+        while True:
+            parts = await self._read_response()
+            first = parts[0]
+            if first.startswith(b'* '):
+                untagged.append(self._parse_untagged(parts))
+            elif first.startswith(tag + b' '):
+                status, _, text = first[len(tag) + 1:].partition(b' ')
+                if status.upper() != b'OK':
+                    text = text.decode('utf-8', 'replace')
+                    raise ImapError('%s failed: %s' % (name, text), text)
+                return text, untagged
+
+    async def _uid(self, name, *args):
+        return await self._command('UID', name.encode('ascii'), *args,
+                                   command=name)
+
+    async def capabilities(self):
+        'Returns the server capability list.'
+        if self._capabilities is None:
+            text, untagged = await self._command('CAPABILITY')
+            for resp in untagged:
+                if resp and resp[0] == b'CAPABILITY':
+                    self._capabilities = tuple(
+                        c.upper() for c in resp[1:] if isinstance(c, bytes))
+        return self._capabilities or ()
+
+    async def has_capability(self, capability):
+        'Return ``True`` if the IMAP server has the given *capability*.'
+        return _to_bytes(capability).upper() in await self.capabilities()
+
+    async def enable(self, *capabilities):
+        'Activate server side capability extensions; return those enabled.'
+        text, untagged = await self._command(
+            'ENABLE', *(_to_bytes(c).upper() for c in capabilities))
+        enabled = [c.upper() for resp in untagged if resp[0] == b'ENABLED'
+                   for c in resp[1:] if isinstance(c, bytes)]
+        self.enabled |= set(enabled)
+        return enabled
+
+    async def login(self, username, password):
+        'Login using *username* and *password*, returning the'
+        try:
+            text, untagged = await self._command(
+                'LOGIN', _quote(username), _quote(password))
+        except ImapAbort:
+            raise
+        except ImapError as exn:
+            raise LoginError(exn.text or str(exn))
+        self._capabilities = None
+        self._update_capabilities(text)
+        return text
+
+    async def logout(self):
+        'Logout, returning the server response.'
+        try:
+            text, untagged = await self._command('LOGOUT')
+        finally:
+            self._close()
+        return text
+
+    async def shutdown(self):
+        'Close the connection to the IMAP server (without logging out)'
+        self._close()
+
+    async def noop(self):
+        'Execute the NOOP command.'
+        return await self._command('NOOP')
+
+    async def select_folder(self, folder, readonly=False):
+        'Set the current folder on the server.'
+        text, untagged = await self._command(
+            'EXAMINE' if readonly else 'SELECT', _quote(folder),
+            command='SELECT')
+        result = {}
+        for resp in untagged:
+            if resp[0] == b'OK' and len(resp) > 1:
+                mo = _RESP_CODE.match(resp[1])
+                if mo is None:
+                    continue
+                key, data = mo.group('key'), mo.group('data') or b''
+                if key in _INT_CODES:
+                    result[key] = int(data)
+                elif key == b'PERMANENTFLAGS':
+                    result[key] = tuple(data.strip(b'()').split())
+            elif len(resp) == 2 and resp[1] in (b'EXISTS', b'RECENT'):
+                result[resp[1]] = resp[0]
+            elif resp[0] == b'FLAGS':
+                result[b'FLAGS'] = resp[1]
+        if b'[READ-WRITE]' in text.upper():
+            result[b'READ-WRITE'] = True
+        return result
+
+    async def close_folder(self):
+        'Close the currently selected folder, returning the server'
+        text, untagged = await self._command('CLOSE')
+        return text
+
+    async def expunge(self):
+        'Remove any messages from the currently selected folder that'
+        return await self._command('EXPUNGE')
+
+    async def search(self, criteria='ALL', charset=None):
+        'Return a list of messages ids from the currently selected'
+        args = (b'CHARSET', _to_bytes(charset)) if charset else ()
+        text, untagged = await self._uid(
+            'SEARCH', *(args + (_criteria(criteria),)))
+        result = []
+        for resp in untagged:
+            if resp[0] == b'SEARCH':
+                result.extend(v for v in resp[1:] if isinstance(v, int))
+        return result
+
+    async def fetch(self, messages, data, modifiers=None):
+        'Retrieve selected *data* associated with one or more'
+        args = (_message_set(messages), _item_list(data))
+        if modifiers:
+            args += (_item_list(modifiers),)
+        text, untagged = await self._uid('FETCH', *args)
+        return self._fetch_result(untagged)
+
+    async def fetch_changes(self, messages, data, modseq):
+        '''fetch() of the *messages* changed since *modseq*, with QRESYNC
+        enabled. Returns the result and the (first, last) UID ranges of
+        the messages expunged since.'''
+        text, untagged = await self._uid(
+            'FETCH', _message_set(messages), _item_list(data),
+            b'(CHANGEDSINCE %d VANISHED)' % modseq)
+        vanished = []
+        for resp in untagged:
+            if resp and resp[0] == b'VANISHED':
+                vanished.extend(uid_ranges(resp[-1]))
+        return self._fetch_result(untagged), vanished
+
+    def _fetch_result(self, untagged):
+        result = {}
+        for resp in untagged:
+            if len(resp) != 3 or resp[1] != b'FETCH':
+                continue
+            seq, items = resp[0], resp[2]
+            msg_id = seq
+            msg_data = {b'SEQ': seq}
+            for key, value in zip(items[::2], items[1::2]):
+                key = key.upper()
+                if key == b'UID':
+                    msg_id = value
+                else:
+                    msg_data[key] = value
+            result.setdefault(msg_id, {}).update(msg_data)
+        return result
+
+    async def _store(self, cmd, messages, flags, silent):
+        if not messages:
+            return {}
+        if silent:
+            cmd += b'.SILENT'
+        text, untagged = await self._uid(
+            'STORE', _message_set(messages), cmd, _item_list(flags))
+        if silent:
+            return None
+        return {msg_id: data.get(b'FLAGS')
+                for msg_id, data in self._fetch_result(untagged).items()}
+
+    async def add_flags(self, messages, flags, silent=False):
+        'Add *flags* to *messages* in the currently selected folder.'
+        return await self._store(b'+FLAGS', messages, flags, silent)
+
+    async def remove_flags(self, messages, flags, silent=False):
+        'Remove one or more *flags* from *messages* in the currently'
+        return await self._store(b'-FLAGS', messages, flags, silent)
+
+    async def set_flags(self, messages, flags, silent=False):
+        'Set the *flags* for *messages* in the currently selected'
+        return await self._store(b'FLAGS', messages, flags, silent)
+
+    async def folder_status(self, folder, what=None):
+        'Return the status of *folder*.'
+        what = what or ('MESSAGES', 'RECENT', 'UIDNEXT', 'UIDVALIDITY',
+                        'UNSEEN')
+        text, untagged = await self._command(
+            'STATUS', _quote(folder), _item_list(what))
+        for resp in untagged:
+            if resp[0] == b'STATUS':
+                items = resp[-1]
+                return dict(zip(items[::2], items[1::2]))
+        return {}
+
+    async def idle(self):
+        'Put the server into IDLE mode.'
+        await self._lock.acquire()
+        try:
+            tag = b'A%d' % next(self._tags)
+            await self._send((tag, b'IDLE'))
+            while True:
+                parts = await self._read_response()
+                if parts[0].startswith(b'+'):
+                    break
+                if parts[0].startswith(tag + b' '):
+                    raise ImapError('IDLE failed: %r' % parts[0])
+            self._idle_tag = tag
+        except BaseException:
+            self._lock.release()
+            raise
+
+    async def idle_check(self, timeout=None):
+        'Check for any IDLE responses sent by the server.'
+        if self._idle_tag is None:
+            raise ImapError('not in IDLE mode')
+        # Only waiting for a response to start may time out: readline()
+        # keeps a partial line buffered when cancelled, but a response
+        # abandoned after its first line would leave the rest of it, such
+        # as a literal, to be misread as the next response.
+        try:
+            line = await asyncio.wait_for(self._read_line(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return [self._parse_untagged(await self._read_response(line))]
+
+    async def idle_done(self):
+        'Take the server out of IDLE mode.'
+        if self._idle_tag is None:
+            raise ImapError('not in IDLE mode')
+        tag, self._idle_tag = self._idle_tag, None
+        try:
+            self._writer.write(b'DONE\r\n')
+            await self._writer.drain()
+            return await self._wait_tagged(tag, 'IDLE')
+        finally:
+            self._lock.release()
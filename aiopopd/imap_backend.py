@@ -1,115 +1,365 @@
-import os
-import re
 import ssl
+import time
+import socket
 import queue
 import asyncio
 import threading
+import collections
 # Import encodings.idna to prevent LookupError on some systems
 import encodings.idna  # noqa
 
 from imapclient import IMAPClient
+from imapclient.imapclient import join_message_ids, seq_to_parenstr_upper
+from imapclient.response_parser import parse_fetch_response
 import email
 import imapclient
 
+from aiopopd.index import uid_ranges
+
+
+class RangeIMAPClient(IMAPClient):
+    '''IMAPClient whose fetch() also takes a message set such as "1:*".
+
+    Since IMAPClient 2.2, fetch() drops every response whose message id was
+    not passed as a number, which discards the whole result for a range.
+    '''
+
+    def fetch(self, messages, data, modifiers=None):
+        if not isinstance(messages, (str, bytes)):
+            return super().fetch(messages, data, modifiers)
+        args = [
+            'FETCH',
+            join_message_ids(messages),
+            seq_to_parenstr_upper(data),
+            seq_to_parenstr_upper(modifiers) if modifiers else None
+        ]
+        if self.use_uid:
+            args.insert(0, 'UID')
+        tag = self._imap._command(*args)
+        typ, data = self._imap._command_complete('FETCH', tag)
+        self._checkok('fetch', typ, data)
+        typ, data = self._imap._untagged_response(typ, data, 'FETCH')
+        return parse_fetch_response(data, self.normalise_times, self.use_uid)
+
+    def fetch_changes(self, messages, data, modseq):
+        untagged = self._imap.untagged_responses
+        untagged.pop('VANISHED', None)
+        result = self.fetch(messages, data,
+                            ['CHANGEDSINCE %d' % modseq, 'VANISHED'])
+        vanished = []
+        for line in untagged.pop('VANISHED', []):
+            vanished.extend(uid_ranges(line.split()[-1]))
+        return result, vanished
+
+
+# IMAP command sent by each IMAPClient method, under which its round trip
+# is recorded as AsyncImapBackend records it; methods not listed send the
+# command they are named after, and those mapped to None are not recorded
+# as they only wait for the server.
+COMMANDS = {
+    'capabilities': 'capability',
+    'has_capability': 'capability',
+    'select_folder': 'select',
+    'close_folder': 'close',
+    'folder_status': 'status',
+    'fetch_changes': 'fetch',
+    'get_flags': 'fetch',
+    'add_flags': 'store',
+    'remove_flags': 'store',
+    'set_flags': 'store',
+    'delete_messages': 'store',
+    'list_folders': 'list',
+    'folder_exists': 'list',
+    'list_sub_folders': 'lsub',
+    'create_folder': 'create',
+    'delete_folder': 'delete',
+    'rename_folder': 'rename',
+    'subscribe_folder': 'subscribe',
+    'unsubscribe_folder': 'unsubscribe',
+    'xlist_folders': 'xlist',
+    'id_': 'id',
+    'idle_check': None,
+    'idle_done': None,
+    'shutdown': None,
+}
+
+
+class ImapWorkerPool:
+    '''Fixed number of threads shared by the IMAP connections of many sessions.
+
+    Threads are started on first use, so a pool may be created before the
+    process forks.
+    '''
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('pool size must be positive')
+        self.size = size
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._submitted = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, fn):
+        if not self._threads:
+            for i in range(self.size):
+                thread = threading.Thread(
+                    target=self._worker, name='imap-worker-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._submitted += 1
+        self._jobs.put((time.monotonic(), fn))
+
+    def _worker(self):
+        while True:
+            enqueued, fn = self._jobs.get()
+            if fn is None:
+                break
+            wait = time.monotonic() - enqueued
+            with self._lock:
+                self._busy += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                fn()
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._completed += 1
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._jobs.put((None, None))
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._busy
+            return {
+                'workers': len(self._threads),
+                'busy': self._busy,
+                'queue_depth': self._jobs.qsize(),
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'wait_avg': self._wait_total / started if started else 0.0,
+                'wait_max': self._wait_max,
+            }
+
 
 class ImapBackend:
     BREAK = object()
     NOOP = object()
+    # Raised by login() when the server rejects the credentials
+    login_errors = (imapclient.exceptions.LoginError,)
 
-    def __init__(self, loop, host, port, ssl):
+    def __init__(self, loop, host, port, ssl, executor=None, metrics=None):
         self._loop = loop
         self._host = host
         self._port = port
         self._ssl = ssl
-        self._command_queue = queue.Queue()
-        self._response_queue = queue.Queue()
-        self._ready_r, self._ready_w = os.pipe()
-        self._loop.add_reader(self._ready_r, self._ready)
-        self._ready = threading.Event()
-        self._thread = threading.Thread(None, self._run)
+        self._executor = executor
+        # Capabilities turned on with enable(), as upper case bytes
+        self.enabled = frozenset()
+        # Records the round trip of each call
+        self._metrics = metrics
         self._breaking = False
-
-    def __del__(self):
-        if self._ready_r is not None:
-            os.close(self._ready_r)
-            os.close(self._ready_w)
-            self._ready_r = self._ready_w = None
+        # The IMAPClient, once connected
+        self._conn = None
+        if executor is None:
+            # Run all commands on a thread of our own
+            self._command_queue = queue.Queue()
+            self._thread = threading.Thread(None, self._run,
+                                            name='imap-backend')
+        else:
+            # Run each command as a job on a shared ImapWorkerPool, one at a
+            # time: the next (future, method, args) is only submitted once
+            # the one before has finished, even if its caller gave up.
+            self._shutdown_called = False
+            self._jobs = collections.deque()
+            self._jobs_lock = threading.Lock()
+            self._job_running = False
 
     def connection_lost(self):
-        self._loop.remove_reader(self._ready_r)
-        os.close(self._ready_r)
-        os.close(self._ready_w)
-        self._ready_r = self._ready_w = None
+        # The POP3 client went away without QUIT; close the IMAP connection
+        # without waiting for it.
+        if self._breaking:
+            return
+        self._breaking = True
+        if self._executor is None:
+            if self._thread.ident is not None:
+                self._command_queue.put_nowait((None, self.BREAK, ()))
+        else:
+            self._submit(None, self.BREAK, ())
+
+    def abort(self):
+        # Like connection_lost, but also interrupt the command in progress
+        # by shutting down the socket under the worker thread.
+        self.connection_lost()
+        conn = self._conn
+        if conn is not None:
+            try:
+                conn.socket().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     async def connect(self):
-        self._thread.start()
+        if self._executor is None:
+            self._thread.start()
 
     async def disconnect(self):
         await self.logout()
         await self._call(self.BREAK)
-        self._thread.join()
+        if self._executor is None:
+            self._thread.join()
 
     async def _call(self, method, *args):
         if self._breaking:
             raise Exception('connection is closing')
         future = asyncio.Future(loop=self._loop)
-        self._command_queue.put_nowait((future, method, args))
         if method is self.BREAK:
             self._breaking = True
-        result = await future
+        histogram = None
+        if self._metrics is not None and isinstance(method, str):
+            command = COMMANDS.get(method, method)
+            if command is not None:
+                histogram = self._metrics.imap_call(command)
+                start = self._loop.time()
+        if self._executor is None:
+            self._command_queue.put_nowait((future, method, args))
+            result = await future
+        else:
+            self._submit(future, method, args)
+            result = await future
+        if histogram is not None:
+            histogram.observe(self._loop.time() - start)
         if isinstance(result, Exception):
             raise result
         return result
 
-    def _run(self):
-        # Run commands in thread
+    def _open(self):
         if self._ssl:
             kwargs = dict(
                 ssl_context=ssl.create_default_context())
         else:
             kwargs = {}
+        return RangeIMAPClient(self._host, self._port, ssl=self._ssl,
+                               **kwargs)
+
+    def _deliver(self, future, result):
+        # Called on a worker thread; complete the future on the event loop.
+        if future is None:
+            return
         try:
-            conn = IMAPClient(self._host, self._port, ssl=self._ssl, **kwargs)
+            self._loop.call_soon_threadsafe(self._set_result, future, result)
+        except RuntimeError:
+            # Event loop is closed
+            pass
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.cancelled():
+            future.set_result(result)
+
+    def _run(self):
+        # Run commands in thread
+        try:
+            conn = self._conn = self._open()
         except Exception as exn:
             future, method, args = self._command_queue.get()
-            self._response_queue.put((future, exn))
+            self._deliver(future, exn)
             self._command_queue.task_done()
-            os.write(self._ready_w, b'x')
             return
         shutdown_called = False
         try:
             while True:
                 future, method, args = self._command_queue.get()
-                if method in ('shutdown', 'logout'):
-                    shutdown_called = True
                 if method is self.BREAK:
                     break
-                elif method is self.NOOP:
+                elif method is self.NOOP or future.cancelled():
+                    # Nobody is waiting for the result of a cancelled call
                     result = None
                 else:
-                    # TODO check if future is cancelled
+                    if method in ('shutdown', 'logout'):
+                        shutdown_called = True
                     try:
                         result = getattr(conn, method)(*args)
                     except Exception as exn:
                         result = exn
-                self._response_queue.put((future, result))
+                self._deliver(future, result)
                 self._command_queue.task_done()
-                os.write(self._ready_w, b'x')
         finally:
             if not shutdown_called:
-                conn.shutdown()
+                try:
+                    conn.shutdown()
+                except Exception:
+                    # Perhaps aborted
+                    pass
 
         assert method is self.BREAK
-        self._response_queue.put((future, None))
+        self._deliver(future, None)
         self._command_queue.task_done()
-        os.write(self._ready_w, b'x')
 
-    def _ready(self):
-        os.read(self._ready_r, 1)
-        future, result = self._response_queue.get_nowait()
-        if not future.cancelled():
-            future.set_result(result)
-        self._response_queue.task_done()
+    def _submit(self, future, method, args):
+        with self._jobs_lock:
+            self._jobs.append((future, method, args))
+            if self._job_running:
+                return
+            self._job_running = True
+        self._executor.submit(self._run_job)
+
+    def _run_job(self):
+        # Run the next job on a pool thread, then queue the one after it
+        # behind the jobs of other connections
+        with self._jobs_lock:
+            job = self._jobs.popleft()
+        self._execute(*job)
+        with self._jobs_lock:
+            if not self._jobs:
+                self._job_running = False
+                return
+        self._executor.submit(self._run_job)
+
+    def _execute(self, future, method, args):
+        # Run one command on a pool thread
+        if method is self.BREAK:
+            if self._conn is not None and not self._shutdown_called:
+                try:
+                    self._conn.shutdown()
+                except Exception:
+                    pass
+            self._conn = None
+            result = None
+        elif method is self.NOOP or future.cancelled():
+            result = None
+        else:
+            if method in ('shutdown', 'logout'):
+                self._shutdown_called = True
+            try:
+                if self._conn is None:
+                    self._conn = self._open()
+                result = getattr(self._conn, method)(*args)
+            except Exception as exn:
+                result = exn
+        self._deliver(future, result)
+
+    async def enable(self, *capabilities):
+        'Activate server side capability extensions; return those enabled.'
+        enabled = await self._call('enable', *capabilities)
+        self.enabled |= {c.upper() for c in enabled}
+        return enabled
+
+    async def fetch_changes(self, messages, data, modseq):
+        '''fetch() of the *messages* changed since *modseq*, with QRESYNC
+        enabled. Returns the result and the (first, last) UID ranges of
+        the messages expunged since.'''
+        return await self._call('fetch_changes', messages, data, modseq)
 
     # The following methods were generated by gen-imap.py
     async def add_flags(self, messages, flags, silent=False):
@@ -0,0 +1,314 @@
+import os
+import json
+import bisect
+import asyncio
+import hashlib
+
+from aiopopd.pop import log
+
+
+SEEN = br'\Seen'
+
+
+class MailboxIndex:
+    '''UID, size and \\Seen state of every message in one IMAP folder.
+
+    uids is kept sorted, so it is also the sequence number order. changed
+    tells whether the index differs from the one last saved or loaded.
+    '''
+
+    def __init__(self, uidvalidity, uidnext=1, highestmodseq=None):
+        self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+        self.highestmodseq = highestmodseq
+        self.uids = []
+        self.sizes = []
+        self.seen = []
+        self.changed = True
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _position(self, uid):
+        i = bisect.bisect_left(self.uids, uid)
+        if i < len(self.uids) and self.uids[i] == uid:
+            return i
+
+    def add(self, uid, size, seen):
+        i = self._position(uid)
+        if i is not None:
+            if self.sizes[i] == size and self.seen[i] == seen:
+                return
+            self.sizes[i] = size
+            self.seen[i] = seen
+        elif not self.uids or uid > self.uids[-1]:
+            self.uids.append(uid)
+            self.sizes.append(size)
+            self.seen.append(seen)
+        else:
+            i = bisect.bisect_left(self.uids, uid)
+            self.uids.insert(i, uid)
+            self.sizes.insert(i, size)
+            self.seen.insert(i, seen)
+        self.set_uidnext(uid + 1)
+        self.changed = True
+
+    def set_uidnext(self, uidnext):
+        if uidnext > self.uidnext:
+            self.uidnext = uidnext
+            self.changed = True
+
+    def set_highestmodseq(self, highestmodseq):
+        if highestmodseq != self.highestmodseq:
+            self.highestmodseq = highestmodseq
+            self.changed = True
+
+    def set_seen(self, uid, seen):
+        i = self._position(uid)
+        if i is not None and self.seen[i] != seen:
+            self.seen[i] = seen
+            self.changed = True
+
+    def retain(self, uids):
+        'Forget every message whose UID is not in the set *uids*.'
+        keep = [i for i, uid in enumerate(self.uids) if uid in uids]
+        if len(keep) == len(self.uids):
+            return
+        self.uids = [self.uids[i] for i in keep]
+        self.sizes = [self.sizes[i] for i in keep]
+        self.seen = [self.seen[i] for i in keep]
+        self.changed = True
+
+    def discard(self, first, last):
+        'Forget the messages with a UID from *first* to *last*.'
+        i = bisect.bisect_left(self.uids, first)
+        j = bisect.bisect_right(self.uids, last)
+        if i < j:
+            del self.uids[i:j]
+            del self.sizes[i:j]
+            del self.seen[i:j]
+            self.changed = True
+
+    def expunge(self, n):
+        'Forget the message with sequence number *n*.'
+        del self.uids[n - 1]
+        del self.sizes[n - 1]
+        del self.seen[n - 1]
+        self.changed = True
+
+    def unseen(self):
+        'Return (uid, size) for every message without \\Seen.'
+        return [(uid, size)
+                for uid, size, seen in zip(self.uids, self.sizes, self.seen)
+                if not seen]
+
+    def to_json(self):
+        # Copies, so the result can be written out while the index changes
+        return {
+            'uidvalidity': self.uidvalidity,
+            'uidnext': self.uidnext,
+            'highestmodseq': self.highestmodseq,
+            'uids': list(self.uids),
+            'sizes': list(self.sizes),
+            'seen': [int(s) for s in self.seen],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        index = cls(data['uidvalidity'], data['uidnext'],
+                    data['highestmodseq'])
+        index.uids = data['uids']
+        index.sizes = data['sizes']
+        index.seen = [bool(s) for s in data['seen']]
+        if not (len(index.uids) == len(index.sizes) == len(index.seen)):
+            raise ValueError('inconsistent index')
+        index.changed = False
+        return index
+
+
+class IndexStore:
+    '''Directory of MailboxIndex files, one per (user, host, folder).
+
+    The UIDVALIDITY is stored in the file and checked by the caller, so a
+    stale index is simply replaced by a full scan. save_soon() writes an
+    index that changed in the background, in order for each key.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # key -> task writing the latest index saved under the key
+        self._saving = {}
+
+    def _filename(self, key):
+        digest = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.json')
+
+    def _load(self, key):
+        try:
+            with open(self._filename(key)) as fp:
+                return MailboxIndex.from_json(json.load(fp))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as exn:
+            log.warning('Discarding unreadable index for %r: %s', key, exn)
+            return None
+
+    def _save(self, key, data):
+        filename = self._filename(key)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.replace(tmp, filename)
+
+    async def load(self, key):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._load, key)
+
+    async def save(self, key, index):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._save, key, index.to_json())
+        index.changed = False
+
+    def save_soon(self, key, index):
+        '''Write *index* in the background if it changed since it was
+        loaded or saved. An index without UIDVALIDITY is never written.'''
+        if not index.changed or index.uidvalidity is None:
+            return
+        index.changed = False
+        task = asyncio.ensure_future(self._save_after(
+            self._saving.get(key), key, index.to_json()))
+        self._saving[key] = task
+        task.add_done_callback(
+            lambda task: self._saving.get(key) is task and
+            self._saving.pop(key))
+
+    async def _save_after(self, previous, key, data):
+        if previous is not None:
+            await asyncio.wait([previous])
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._save, key, data)
+        except OSError as exn:
+            log.warning('Could not save the index for %r: %s', key, exn)
+
+
+def _is_seen(flags):
+    return SEEN in flags
+
+
+def uid_ranges(uids):
+    'Return (first, last) for each range of the IMAP UID set *uids*.'
+    if isinstance(uids, int):
+        return [(uids, uids)]
+    ranges = []
+    for part in uids.split(b','):
+        first, _, last = part.partition(b':')
+        first = int(first)
+        last = int(last) if last else first
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+async def full_scan(backend, info):
+    # Without UIDVALIDITY the index is only good for this session
+    index = MailboxIndex(info.get(b'UIDVALIDITY'), info.get(b'UIDNEXT', 1),
+                         info.get(b'HIGHESTMODSEQ'))
+    if info.get(b'EXISTS'):
+        data = await backend.fetch('1:*', ['FLAGS', 'RFC822.SIZE'])
+        for uid in sorted(data):
+            value = data[uid]
+            index.add(uid, value[b'RFC822.SIZE'], _is_seen(value[b'FLAGS']))
+    return index
+
+
+async def fetch_new(backend, index):
+    'Add the messages with a UID of at least index.uidnext to *index*.'
+    old_uidnext = index.uidnext
+    data = await backend.fetch('%d:*' % old_uidnext, ['FLAGS', 'RFC822.SIZE'])
+    for uid in sorted(data):
+        # "n:*" always includes the last message, even if it is old
+        if uid >= old_uidnext:
+            value = data[uid]
+            index.add(uid, value[b'RFC822.SIZE'], _is_seen(value[b'FLAGS']))
+
+
+def apply_untagged(index, response):
+    '''Update *index* from an untagged *response* received during IDLE.
+
+    The index must hold every message of the folder up to the last one it
+    knows, so sequence number n is the message at position n - 1. Returns
+    True if the folder now has messages that are missing from the index.
+    '''
+    if len(response) >= 2 and response[0] == b'VANISHED':
+        # With QRESYNC enabled, in place of EXPUNGE
+        for first, last in uid_ranges(response[-1]):
+            index.discard(first, last)
+        return False
+    if len(response) < 2 or not isinstance(response[0], int):
+        return False
+    n, kind = response[0], response[1].upper()
+    if kind == b'EXISTS':
+        return n > len(index)
+    if kind == b'EXPUNGE' and n <= len(index):
+        index.expunge(n)
+    elif kind == b'FETCH' and len(response) > 2 and n <= len(index):
+        items = response[2]
+        data = {k.upper(): v for k, v in zip(items[::2], items[1::2])}
+        if b'FLAGS' in data:
+            index.set_seen(index.uids[n - 1], _is_seen(data[b'FLAGS']))
+    return False
+
+
+async def sync_index(backend, index, info):
+    '''Bring *index* up to date with the folder just selected on *backend*.
+
+    *info* is the result of select_folder(). Only messages added since the
+    last sync, by UIDNEXT, are fetched in full. With QRESYNC enabled on the
+    backend, one FETCH CHANGEDSINCE returns the flag changes and the
+    expunged messages; with CONDSTORE, it returns the flag changes. Without
+    either, the \\Seen state comes from SEARCH UNSEEN. Otherwise expunged
+    messages are only looked for when the message count does not add up.
+    Without a usable index, the whole folder is scanned.
+
+    Returns the new index, which may be a different object; its changed
+    attribute tells whether it needs to be saved.
+    '''
+    uidvalidity = info.get(b'UIDVALIDITY')
+    if (index is None or uidvalidity is None or
+            index.uidvalidity != uidvalidity):
+        return await full_scan(backend, info)
+    exists = info.get(b'EXISTS', 0)
+    uidnext = info.get(b'UIDNEXT')
+    modseq = info.get(b'HIGHESTMODSEQ')
+    old_uidnext = index.uidnext
+
+    if index.uids:
+        known = '1:%d' % (old_uidnext - 1)
+        if modseq is not None and index.highestmodseq is not None:
+            if modseq != index.highestmodseq:
+                if b'QRESYNC' in getattr(backend, 'enabled', ()):
+                    data, vanished = await backend.fetch_changes(
+                        known, ['FLAGS'], index.highestmodseq)
+                    for first, last in vanished:
+                        index.discard(first, last)
+                else:
+                    data = await backend.fetch(
+                        known, ['FLAGS'],
+                        ['CHANGEDSINCE %d' % index.highestmodseq])
+                for uid, value in data.items():
+                    index.set_seen(uid, _is_seen(value[b'FLAGS']))
+        else:
+            unseen = set(await backend.search('UNSEEN'))
+            for uid in index.uids:
+                index.set_seen(uid, uid not in unseen)
+
+    if exists and (uidnext is None or uidnext > old_uidnext):
+        await fetch_new(backend, index)
+
+    if len(index) != exists:
+        index.retain(set(await backend.search('ALL')) if exists else set())
+    if uidnext is not None:
+        index.set_uidnext(uidnext)
+    index.set_highestmodseq(modseq)
+    return index
@@ -4,8 +4,17 @@ import logging
 import argparse
 import subprocess
 from aiopopd.pop import Pop3
-from aiopopd.imap import ImapHandlerFixed
-from aiopopd.controller import Controller
+from aiopopd.imap import ImapHandlerFixed, BACKENDS
+from aiopopd.controller import (
+    Controller, LOOPS, PROFILES, new_event_loop, configure_loop)
+
+
+# Arguments to "openssl req" for the key of a generated certificate
+KEY_TYPES = {
+    'rsa': ['-newkey', 'rsa:4096'],
+    # Signing with P-256 is much cheaper than with RSA-4096
+    'ecdsa': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+}
 
 
 parser = argparse.ArgumentParser()
@@ -18,6 +27,12 @@ parser.add_argument('-l', '--systemd-logging', action='store_true')
 parser.add_argument('--ssl-key')
 parser.add_argument('--ssl-cert')
 parser.add_argument('--ssl-generate', action='store_true')
+parser.add_argument('--ssl-key-type', choices=sorted(KEY_TYPES), default='rsa')
+parser.add_argument('--ssl-tickets', type=int, default=2)
+parser.add_argument('--imap-backend', choices=sorted(BACKENDS),
+                    default='thread')
+parser.add_argument('--loop', choices=LOOPS, default='asyncio')
+parser.add_argument('--loop-profile', choices=PROFILES, default='production')
 
 
 def get_ssl_context(args):
@@ -33,13 +48,26 @@ def get_ssl_context(args):
 
     if generate:
         subprocess.check_call(
-            ['openssl', 'req', '-x509', '-newkey', 'rsa:4096',
-             '-keyout', args.ssl_key, '-out', args.ssl_cert, '-days', '365',
+            ['openssl', 'req', '-x509'] + KEY_TYPES[args.ssl_key_type] +
+            ['-keyout', args.ssl_key, '-out', args.ssl_cert, '-days', '365',
              '-nodes', '-subj', '/CN=localhost'])
 
-    # Load SSL context
+    # Load SSL context. The key may be RSA or ECDSA.
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     context.load_cert_chain(args.ssl_cert, args.ssl_key)
+
+    # Let clients that reconnect skip the full handshake. TLS 1.3 clients
+    # get num_tickets session tickets per connection; TLS 1.2 clients get
+    # a ticket, or with --ssl-tickets 0 a session ID in this process's
+    # session cache. Ticket keys are generated when the context is created,
+    # so worker processes forked after this accept each other's tickets.
+    if args.ssl_tickets < 0:
+        raise SystemExit('--ssl-tickets must not be negative')
+    context.num_tickets = args.ssl_tickets
+    if args.ssl_tickets:
+        context.options &= ~ssl.OP_NO_TICKET
+    else:
+        context.options |= ssl.OP_NO_TICKET
     return context
 
 
@@ -71,14 +99,19 @@ def main():
         log.setFormatter(SystemdFormatter())
 
     def factory():
-        return Pop3(ImapHandlerFixed(args.imap_hostname,
-                                     args.imap_port,
-                                     args.imap_ssl))
+        handler = ImapHandlerFixed(args.imap_hostname, args.imap_port,
+                                   args.imap_ssl,
+                                   backend_class=BACKENDS[args.imap_backend])
+        return Pop3(handler)
 
-    controller = Controller(None, port=args.listen_port,
+    try:
+        loop = new_event_loop(args.loop)
+    except ValueError as exn:
+        raise SystemExit(str(exn))
+    configure_loop(loop, args.loop_profile)
+    controller = Controller(None, loop=loop, port=args.listen_port,
                             ssl_context=ssl_context, setuid=args.setuid)
     controller.factory = factory
-    controller.loop.set_debug(enabled=True)
     try:
         controller.start()
     except PermissionError:
@@ -0,0 +1,75 @@
+import itertools
+from array import array
+
+
+# IMAP UIDs are unsigned 32-bit numbers
+UID_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+_INVERT = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+
+class MessageTable:
+    '''The messages offered in one POP3 session, numbered from 1.
+
+    UIDs and sizes are stored in arrays and deletion marks in a bytearray,
+    so a message costs 13 bytes instead of a Python object. The number and
+    total size of the messages not marked as deleted are kept up to date,
+    making STAT O(1).
+
+    Like a list, the accessors raise IndexError for a message number past
+    the end.
+    '''
+
+    def __init__(self, uids=(), sizes=()):
+        self.uids = array(UID_TYPECODE, uids)
+        self.sizes = array('Q', sizes)
+        if len(self.uids) != len(self.sizes):
+            raise ValueError('uids and sizes differ in length')
+        self.deleted = bytearray(len(self.uids))
+        self.total_octets = sum(self.sizes)
+        self.count = len(self.uids)
+        self.octets = self.total_octets
+
+    def __len__(self):
+        return len(self.uids)
+
+    @staticmethod
+    def _index(n):
+        if n < 1:
+            raise IndexError(n)
+        return n - 1
+
+    def uid(self, n):
+        return self.uids[self._index(n)]
+
+    def size(self, n):
+        return self.sizes[self._index(n)]
+
+    def is_deleted(self, n):
+        return bool(self.deleted[self._index(n)])
+
+    def delete(self, n):
+        'Mark message *n* as deleted. Return False if it already was.'
+        i = self._index(n)
+        if self.deleted[i]:
+            return False
+        self.deleted[i] = 1
+        self.count -= 1
+        self.octets -= self.sizes[i]
+        return True
+
+    def reset(self):
+        'Unmark all messages marked as deleted.'
+        if self.count != len(self.uids):
+            self.deleted = bytearray(len(self.uids))
+            self.count = len(self.uids)
+            self.octets = self.total_octets
+
+    def deleted_uids(self):
+        return list(itertools.compress(self.uids, self.deleted))
+
+    def live(self):
+        'Return an iterator of (n, uid, size) for messages not deleted.'
+        rows = zip(itertools.count(1), self.uids, self.sizes)
+        if self.count == len(self.uids):
+            return rows
+        return itertools.compress(rows, self.deleted.translate(_INVERT))
@@ -0,0 +1,207 @@
+import re
+import bisect
+import asyncio
+import threading
+
+
+# Bucket upper bounds, in seconds and in bytes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(2 ** n for n in range(10, 27, 2))  # 1 KiB to 64 MiB
+
+# POP3 session states, reported even when no session is in them
+STATES = ('AUTHORIZATION', 'TRANSACTION')
+
+_UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+class Histogram:
+    '''Counts of observed values by bucket, with their sum.
+
+    Observing a value only increments a counter and adds to the sum; the
+    cumulative counts are worked out when the histogram is rendered.
+    '''
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i] counts values in (bounds[i-1], bounds[i]]; the last
+        # one counts those above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (
+                name, labels, _number(bound), total))
+        total += self.counts[-1]
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, total))
+        labels = '{%s}' % labels.rstrip(',') if labels else ''
+        lines.append('%s_sum%s %s' % (name, labels, _number(self.sum)))
+        lines.append('%s_count%s %d' % (name, labels, total))
+        return lines
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _labelled(histograms):
+    return sorted((_escape(key.decode('ascii', 'backslashreplace')
+                           if isinstance(key, bytes) else key), histogram)
+                  for key, histogram in histograms.items())
+
+
+class Metrics:
+    '''Metrics of one process, in the Prometheus text format.
+
+    Pop3 sessions given a Metrics record their state, logins, the latency
+    of each command and the bytes sent for each RETR; IMAP backends record
+    the round trip of each call. The stats() dicts registered with
+    add_stats() are reported as gauges, and the threads talking to IMAP
+    servers are counted when the metrics are rendered.
+    '''
+
+    def __init__(self):
+        # Open Pop3 sessions
+        self.sessions = set()
+        self.logins_ok = self.logins_failed = 0
+        # Upper case verb as bytes -> Histogram of seconds
+        self.commands = {}
+        # Lower case IMAP command -> Histogram of seconds
+        self.imap_calls = {}
+        self.retr_bytes = Histogram(SIZE_BUCKETS)
+        # (name, function returning a dict of numbers)
+        self._stats = []
+
+    def command(self, verb):
+        'Return the latency histogram of the POP3 command *verb*.'
+        try:
+            return self.commands[verb]
+        except KeyError:
+            histogram = self.commands[verb] = Histogram(LATENCY_BUCKETS)
+            return histogram
+
+    def imap_call(self, command):
+        'Return the round-trip histogram of the IMAP *command*.'
+        try:
+            return self.imap_calls[command]
+        except KeyError:
+            histogram = self.imap_calls[command] = Histogram(LATENCY_BUCKETS)
+            return histogram
+
+    def add_stats(self, name, stats):
+        'Report the numbers returned by *stats* as aiopopd_*name*_* gauges.'
+        self._stats.append((name, stats))
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        states = dict.fromkeys(STATES, 0)
+        for session in self.sessions:
+            state = getattr(session, 'state', 'AUTHORIZATION')
+            states[state] = states.get(state, 0) + 1
+        family('aiopopd_sessions', 'gauge', 'Open POP3 sessions by state.')
+        for state, count in sorted(states.items()):
+            lines.append('aiopopd_sessions{state="%s"} %d' % (
+                _escape(state), count))
+
+        family('aiopopd_logins_total', 'counter', 'POP3 logins by result.')
+        lines.append('aiopopd_logins_total{result="ok"} %d' % self.logins_ok)
+        lines.append('aiopopd_logins_total{result="failed"} %d' %
+                     self.logins_failed)
+
+        family('aiopopd_command_seconds', 'histogram',
+               'POP3 command latency.')
+        for verb, histogram in _labelled(self.commands):
+            lines.extend(histogram.render(
+                'aiopopd_command_seconds', 'verb="%s",' % verb))
+
+        family('aiopopd_imap_call_seconds', 'histogram',
+               'IMAP command round trip.')
+        for command, histogram in _labelled(self.imap_calls):
+            lines.extend(histogram.render(
+                'aiopopd_imap_call_seconds', 'command="%s",' % command))
+
+        family('aiopopd_retr_bytes', 'histogram', 'Bytes sent per RETR.')
+        lines.extend(self.retr_bytes.render('aiopopd_retr_bytes', ''))
+
+        family('aiopopd_imap_threads', 'gauge',
+               'Threads running IMAP connections.')
+        lines.append('aiopopd_imap_threads %d' % sum(
+            1 for thread in threading.enumerate()
+            if thread.name.startswith('imap-')))
+
+        for name, stats in self._stats:
+            for key, value in sorted(stats().items()):
+                if not isinstance(value, (int, float)):
+                    continue
+                metric = _UNSAFE.sub('_', 'aiopopd_%s_%s' % (name, key))
+                lines.append('# TYPE %s gauge' % metric)
+                lines.append('%s %s' % (metric, _number(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsProtocol(asyncio.Protocol):
+    'Answers GET /metrics with the metrics, and every other request with 404.'
+
+    # Longest request head read
+    MAX_REQUEST = 8192
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._buf = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._buf += data
+        if b'\r\n\r\n' not in self._buf and b'\n\n' not in self._buf:
+            if len(self._buf) > self.MAX_REQUEST:
+                self.transport.close()
+            return
+        request = self._buf.split(b'\n', 1)[0].split()
+        self._buf = b''
+        if len(request) < 2 or request[0] not in (b'GET', b'HEAD'):
+            self._respond('405 Method Not Allowed', b'')
+        elif request[1].partition(b'?')[0] != b'/metrics':
+            self._respond('404 Not Found', b'')
+        else:
+            body = self.metrics.render().encode('utf-8')
+            self._respond('200 OK', b'' if request[0] == b'HEAD' else body,
+                          len(body))
+
+    def _respond(self, status, body, length=None):
+        head = ('HTTP/1.0 %s\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % (
+                    status, len(body) if length is None else length))
+        self.transport.write(head.encode('ascii') + body)
+        self.transport.close()
+
+
+def start_metrics_server(metrics, loop, sock):
+    '''Serve *metrics* on the listening socket *sock* from *loop*, which
+    may be running in another thread; return the asyncio Server.'''
+    future = asyncio.run_coroutine_threadsafe(
+        loop.create_server(lambda: MetricsProtocol(metrics), sock=sock), loop)
+    return future.result()
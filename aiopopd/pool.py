@@ -0,0 +1,192 @@
+import asyncio
+import collections
+
+from aiopopd.auth import CredentialHasher
+from aiopopd.index import apply_untagged, fetch_new, sync_index
+from aiopopd.pop import log
+
+
+class _Pooled:
+    __slots__ = ('key', 'backend', 'index', 'timer', 'warmer', 'stopping')
+
+    def __init__(self, key, backend, index):
+        self.key = key
+        self.backend = backend
+        self.index = index
+        self.timer = self.warmer = None
+        self.stopping = False
+
+
+class BackendPool:
+    '''Logged-in IMAP backends kept open between POP3 sessions.
+
+    A backend released after QUIT is kept for *idle_timeout* seconds under
+    its key of (host, port, ssl, username, credential hash), so the next
+    login with the same password skips connecting and LOGIN. A pooled
+    backend is checked with NOOP before it is handed out again. At most
+    *max_idle_per_host* backends are kept per host; releasing one more
+    closes the one idle the longest.
+
+    With *warm*, a backend released together with its MailboxIndex stays in
+    IDLE on INBOX and keeps the index current from the EXISTS, EXPUNGE and
+    FETCH responses, so the next session can list the messages without any
+    IMAP command. IDLE is checked every *idle_poll* seconds, which bounds
+    how long acquire() waits for IDLE to end.
+    '''
+
+    def __init__(self, idle_timeout=300, max_idle_per_host=20,
+                 health_timeout=10, warm=False, idle_poll=0.5):
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.health_timeout = health_timeout
+        self.warm = warm
+        self.idle_poll = idle_poll
+        # Passwords are only kept as a keyed hash
+        self._hash = CredentialHasher()
+        # key -> list of _Pooled, most recently released last
+        self._idle = collections.defaultdict(list)
+        # host -> deque of _Pooled, least recently released first
+        self._idle_by_host = collections.defaultdict(collections.deque)
+        # Task disconnecting a backend that left the pool -> its _Pooled
+        self._closing = {}
+        self.hits = self.misses = self.warm_hits = 0
+        self.expired = self.unhealthy = self.evicted = 0
+
+    def key(self, host, port, ssl, username, password):
+        return (host, port, bool(ssl), username,
+                self._hash(password))
+
+    def _take(self, entry):
+        key = entry.key
+        self._idle[key].remove(entry)
+        if not self._idle[key]:
+            del self._idle[key]
+        self._idle_by_host[key[0]].remove(entry)
+        if not self._idle_by_host[key[0]]:
+            del self._idle_by_host[key[0]]
+        entry.timer.cancel()
+        return entry
+
+    async def acquire(self, key):
+        '''Return (backend, index) for a healthy pooled backend, or None.
+
+        index is the MailboxIndex of INBOX, which is still selected, if the
+        backend was kept warm, and None otherwise.
+        '''
+        while self._idle.get(key):
+            entry = self._take(self._idle[key][-1])
+            if entry.warmer is not None:
+                entry.stopping = True
+                if await entry.warmer:
+                    self.hits += 1
+                    self.warm_hits += 1
+                    return entry.backend, entry.index
+            else:
+                try:
+                    await asyncio.wait_for(entry.backend.noop(),
+                                           self.health_timeout)
+                    self.hits += 1
+                    return entry.backend, None
+                except Exception as exn:
+                    log.info('%s:%s %r Pooled IMAP connection failed '
+                             'NOOP: %r', key[0], key[1], key[3], exn)
+            self.unhealthy += 1
+            entry.backend.connection_lost()
+        self.misses += 1
+        return None
+
+    def release(self, key, backend, index=None):
+        '''Keep *backend*, which must be idle and logged in, for reuse.
+
+        *index* is the MailboxIndex of INBOX to keep current while warm.
+        '''
+        loop = asyncio.get_event_loop()
+        entry = _Pooled(key, backend, index)
+        entry.timer = loop.call_later(self.idle_timeout, self._expire, entry)
+        if self.warm and index is not None:
+            entry.warmer = asyncio.ensure_future(self._keep_warm(entry))
+        self._idle[key].append(entry)
+        by_host = self._idle_by_host[key[0]]
+        by_host.append(entry)
+        while len(by_host) > self.max_idle_per_host:
+            self.evicted += 1
+            self._close(self._take(by_host[0]))
+
+    def close_idle(self, host):
+        '''Close the backend to *host* idle the longest, if any.
+
+        Returns True if a backend is being closed.
+        '''
+        by_host = self._idle_by_host.get(host)
+        if not by_host:
+            return False
+        self.evicted += 1
+        self._close(self._take(by_host[0]))
+        return True
+
+    async def _keep_warm(self, entry):
+        # Return True if the backend is still usable when IDLE ends.
+        backend = entry.backend
+        try:
+            # Catch up with what happened during the session, so the index
+            # matches the folder before relying on sequence numbers.
+            info = await backend.select_folder('INBOX')
+            entry.index = await sync_index(backend, entry.index, info)
+            while not entry.stopping:
+                await backend.idle()
+                missing = False
+                while not entry.stopping and not missing:
+                    for response in await backend.idle_check(self.idle_poll):
+                        missing |= apply_untagged(entry.index, response)
+                text, responses = await backend.idle_done()
+                for response in responses:
+                    missing |= apply_untagged(entry.index, response)
+                if missing:
+                    await fetch_new(backend, entry.index)
+            return True
+        except Exception as exn:
+            log.info('%s:%s %r Keeping IMAP connection warm failed: %r',
+                     entry.key[0], entry.key[1], entry.key[3], exn)
+            return False
+
+    def _expire(self, entry):
+        self.expired += 1
+        self._close(self._take(entry))
+
+    def _close(self, entry):
+        entry.stopping = True
+        task = asyncio.ensure_future(self._disconnect(entry))
+        self._closing[task] = entry
+        task.add_done_callback(self._closing.pop)
+
+    async def close(self, timeout=5):
+        '''Disconnect every pooled backend, for instance before the event
+        loop stops, aborting those that take more than *timeout* seconds.'''
+        entries = [entry for entries in self._idle.values()
+                   for entry in entries]
+        for entry in entries:
+            self._close(self._take(entry))
+        if not self._closing:
+            return
+        done, pending = await asyncio.wait(list(self._closing),
+                                           timeout=timeout)
+        for task in pending:
+            entry = self._closing[task]
+            task.cancel()
+            entry.backend.abort()
+
+    @staticmethod
+    async def _disconnect(entry):
+        if entry.warmer is not None and not await entry.warmer:
+            entry.backend.connection_lost()
+            return
+        try:
+            await entry.backend.disconnect()
+        except Exception as exn:
+            log.debug('Closing pooled IMAP connection: %r', exn)
+
+    def stats(self):
+        return dict(idle=sum(len(v) for v in self._idle.values()),
+                    hits=self.hits, misses=self.misses,
+                    warm_hits=self.warm_hits, expired=self.expired,
+                    unhealthy=self.unhealthy, evicted=self.evicted)
@@ -2,14 +2,86 @@ import socket
 import asyncio
 import logging
 
+from aiopopd.encoder import MultilineEncoder, encode_lines
+
 
 VERSION = '0.1'
 IDENT = 'Python POP3 {}'.format(VERSION)
 log = logging.getLogger('aiopopd.log')
 MISSING = object()
+# High-water mark of the transport's write buffer; output is only drained
+# once this much is buffered
+DRAIN_THRESHOLD = 64 * 1024
+# Stop reading from a client that sends this much without a line break
+INPUT_LIMIT = 64 * 1024
+# Output queued up to this size is joined into one write
+WRITE_CHUNK = 16 * 1024
+# Longest command line accepted, CRLF included. RFC 2449 limits commands to
+# 255 octets, but long passwords are allowed for.
+MAX_LINE_LENGTH = 1024
+# Returned by _readline when the client took too long to send a command
+TIMED_OUT = object()
+
+
+class SessionLimits:
+    '''Admission control and timeouts shared by the sessions of a server.
+
+    At most *max_sessions* sessions are served at once, and at most
+    *max_per_peer* from one client address; 0 means no limit. A client over
+    a limit is greeted with -ERR [SYS/TEMP] and disconnected. A client must
+    log in within *auth_timeout* seconds of connecting, and a logged in
+    client that sends no command for *idle_timeout* seconds is disconnected
+    without deleting any messages (the autologout timer of RFC 1939, which
+    should be at least 10 minutes). None disables a timeout. Command lines
+    longer than *max_line_length* octets are refused.
+    '''
+
+    def __init__(self, max_sessions=0, max_per_peer=0, auth_timeout=None,
+                 idle_timeout=None, max_line_length=MAX_LINE_LENGTH):
+        self.max_sessions = max_sessions
+        self.max_per_peer = max_per_peer
+        self.auth_timeout = auth_timeout
+        self.idle_timeout = idle_timeout
+        self.max_line_length = max_line_length
+        self.sessions = 0
+        # Client address -> sessions
+        self._peers = {}
+        self.refused_busy = self.refused_peer = 0
+        self.auth_timeouts = self.idle_timeouts = 0
+
+    def admit(self, peer):
+        'Return None to admit a session from *peer*, or why it is refused.'
+        if self.max_sessions and self.sessions >= self.max_sessions:
+            self.refused_busy += 1
+            return 'too many connections, try again later'
+        count = self._peers.get(peer, 0)
+        if self.max_per_peer and count >= self.max_per_peer:
+            self.refused_peer += 1
+            return 'too many connections from your address, try again later'
+        self.sessions += 1
+        self._peers[peer] = count + 1
+        return None
 
+    def release(self, peer):
+        self.sessions -= 1
+        count = self._peers.pop(peer) - 1
+        if count:
+            self._peers[peer] = count
 
-def command(state):
+    def stats(self):
+        return dict(sessions=self.sessions, peers=len(self._peers),
+                    refused_busy=self.refused_busy,
+                    refused_peer=self.refused_peer,
+                    auth_timeouts=self.auth_timeouts,
+                    idle_timeouts=self.idle_timeouts)
+
+
+def command(state=None):
+    '''Mark a pop3_* method as only valid in the given session *state*.
+
+    Pop3 and its subclasses dispatch on a table of their pop3_* methods,
+    built when the class is created.
+    '''
     def decorator(fn):
         fn.command_state = state
         return fn
@@ -19,15 +91,56 @@ def command(state):
 
 class Pop3(asyncio.StreamReaderProtocol):
     __ident__ = 'aiopopd'
+    # Commands handled and transport writes made by all sessions
+    commands_total = 0
+    writes_total = 0
+    # TLS handshakes by whether they resumed an earlier session
+    tls_full = tls_resumed = 0
+    # Upper case verb as bytes -> (pop3_* function, state or None)
+    _dispatch = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = cls._build_dispatch()
+
+    @classmethod
+    def _build_dispatch(cls):
+        table = {}
+        for name in dir(cls):
+            if name.startswith('pop3_'):
+                fn = getattr(cls, name)
+                verb = name[5:].upper().encode('ascii')
+                table[verb] = (fn, getattr(fn, 'command_state', None))
+        return table
 
-    def __init__(self, handler, *, hostname=None, loop=None):
+    def __init__(self, handler, *, hostname=None, loop=None, limits=None,
+                 metrics=None):
         self.hostname = hostname or socket.getfqdn()
+        self.limits = limits
+        self.metrics = metrics
+        self.max_line_length = (MAX_LINE_LENGTH if limits is None else
+                                limits.max_line_length)
         self.loop = loop or asyncio.get_event_loop()
+        # Commands are read in data_received; the StreamReader only
+        # completes the protocol's setup.
         super().__init__(
-            asyncio.StreamReader(loop=self.loop),
+            asyncio.StreamReader(),
             client_connected_cb=self._client_connected_cb,
             loop=self.loop)
         self.event_handler = handler
+        self._inbuf = bytearray()
+        self._input_waiter = None
+        self._reading_paused = False
+        self._discarding = False
+        self._outbuf = []
+        self._outbuf_size = 0
+        self.commands = 0
+        self.writes = 0
+        # Bytes of output, queued or written
+        self.bytes_out = 0
+        self._handler_coroutine = None
+        # Client address counted by self.limits
+        self._admitted = None
 
     async def _call_handler_hook(self, command, *args):
         hook = getattr(self.event_handler, 'handle_' + command, None)
@@ -45,45 +158,235 @@ class Pop3(asyncio.StreamReaderProtocol):
         self.username = self.password = None
         super().connection_made(transport)
         self.transport = transport
+        transport.set_write_buffer_limits(high=DRAIN_THRESHOLD)
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            # The handshake is complete before connection_made
+            if ssl_object.session_reused:
+                Pop3.tls_resumed += 1
+            else:
+                Pop3.tls_full += 1
         log.debug('%s Connection opened', self.peer_str)
+        if self.limits is not None:
+            address = self.peer[0] if isinstance(self.peer, tuple) else \
+                self.peer
+            refusal = self.limits.admit(address)
+            if refusal is not None:
+                log.info('%s Refused: %s', self.peer_str, refusal)
+                self._transport_write(
+                    ('-ERR [SYS/TEMP] %s\r\n' % refusal).encode('ascii'))
+                transport.close()
+                return
+            self._admitted = address
+            self._auth_deadline = self.loop.time() + (
+                self.limits.auth_timeout or 0)
+        if self.metrics is not None:
+            self.metrics.sessions.add(self)
         self._handler_coroutine = self.loop.create_task(
             self._handle_client())
 
     def connection_lost(self, error):
-        log.debug('%s Connection lost', self.peer_str)
+        log.debug('%s Connection lost after %s commands, %s writes',
+                  self.peer_str, self.commands, self.writes)
         super().connection_lost(error)
-        self._handler_coroutine.cancel()
+        if self._handler_coroutine is not None:
+            self._handler_coroutine.cancel()
+        if self._admitted is not None:
+            self.limits.release(self._admitted)
+            self._admitted = None
+        if self.metrics is not None:
+            self.metrics.sessions.discard(self)
         self.transport = None
         self.event_handler.connection_lost()
 
+    def data_received(self, data):
+        # Commands are read from our own buffer rather than the
+        # StreamReader, so _handle_client can see whether more of them
+        # have already arrived.
+        self._inbuf += data
+        if len(self._inbuf) > INPUT_LIMIT and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        waiter = self._input_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _readline(self):
+        # Return the next line, None in place of a line longer than
+        # max_line_length, which is discarded, or TIMED_OUT.
+        while True:
+            i = self._inbuf.find(b'\n')
+            if i >= 0:
+                line = bytes(self._inbuf[:i + 1])
+                del self._inbuf[:i + 1]
+                self._resume_if_paused()
+                if self._discarding or len(line) > self.max_line_length:
+                    self._discarding = False
+                    return None
+                return line
+            if len(self._inbuf) > self.max_line_length:
+                self._discarding = True
+                del self._inbuf[:]
+                self._resume_if_paused()
+            # About to wait for the client, so send everything queued
+            self._flush_buffer()
+            await self._drain_if_needed()
+            waiter = self._input_waiter = self.loop.create_future()
+            timeout = self._input_timeout()
+            timer = None
+            if timeout is not None:
+                timer = self.loop.call_later(
+                    timeout, lambda: waiter.done() or
+                    waiter.set_result(TIMED_OUT))
+            try:
+                if await waiter is TIMED_OUT:
+                    return TIMED_OUT
+            finally:
+                self._input_waiter = None
+                if timer is not None:
+                    timer.cancel()
+
+    def _input_timeout(self):
+        # Seconds the client has to send the next command, or None
+        limits = self.limits
+        if limits is None:
+            return None
+        if self.state == 'AUTHORIZATION':
+            if limits.auth_timeout:
+                return max(self._auth_deadline - self.loop.time(), 0)
+        elif limits.idle_timeout:
+            return limits.idle_timeout
+        return None
+
+    def _resume_if_paused(self):
+        if self._reading_paused and len(self._inbuf) <= INPUT_LIMIT:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
     def eof_received(self):
         log.debug('%s EOF received', self.peer_str)
-        self._handler_coroutine.cancel()
+        if self._handler_coroutine is not None:
+            self._handler_coroutine.cancel()
         return super().eof_received()
 
     def _client_connected_cb(self, reader, writer):
         self._reader = reader
         self._writer = writer
 
+    def _write(self, data):
+        # Queue *data*, joining small pieces into fewer transport writes.
+        # Queued output is sent when the session waits for the next
+        # command, or once WRITE_CHUNK bytes are queued.
+        self.bytes_out += len(data)
+        if len(data) >= WRITE_CHUNK:
+            self._flush_buffer()
+            self._transport_write(data)
+            return
+        self._outbuf.append(data)
+        self._outbuf_size += len(data)
+        if self._outbuf_size >= WRITE_CHUNK:
+            self._flush_buffer()
+
+    def _transport_write(self, data):
+        self._writer.write(data)
+        self.writes += 1
+        Pop3.writes_total += 1
+
+    def _flush_buffer(self):
+        if self._outbuf:
+            self._transport_write(b''.join(self._outbuf))
+            self._outbuf = []
+            self._outbuf_size = 0
+
+    async def flush(self):
+        'Write all queued output and wait for the transport to drain.'
+        self._flush_buffer()
+        await self._writer.drain()
+
     async def push(self, status):
         log.debug('%s %r', self.peer_str, status)
-        response = (status + '\r\n').encode('ascii')
-        self._writer.write(response)
-        await self._writer.drain()
+        self._write((status + '\r\n').encode('ascii'))
+        await self._drain_if_needed()
+
+    async def _drain_if_needed(self):
+        if self._writer.transport.get_write_buffer_size() >= DRAIN_THRESHOLD:
+            await self._writer.drain()
 
     async def push_multi(self, status, data):
-        await self.push(status)
+        log.debug('%s %r', self.peer_str, status)
+        self._write((status + '\r\n').encode('ascii'))
         if isinstance(data, list):
-            data = b'\r\n'.join(data)
-        lines = data.split(b'\r\n') if data else []
-        log.debug('%s (%s lines)', self.peer_str, len(lines))
-        for line in lines:
-            if line.startswith(b'.'):
-                line = b'.' + line
-            response = line + b'\r\n'
-            self._writer.write(response)
-            await self._writer.drain()
-        await self.push('.')
+            data = encode_lines(data)
+        log.debug('%s (%s bytes)', self.peer_str, len(data))
+        encoder = MultilineEncoder()
+        for chunk in encoder.feed(data):
+            self._write(chunk)
+            await self._drain_if_needed()
+        self._write(encoder.finish())
+        await self._drain_if_needed()
+
+    async def push_multi_stream(self, status, chunks):
+        '''Like push_multi, but send the data from the async iterable
+        *chunks* as it is produced, waiting for the client to keep up.
+
+        If *chunks* fails after the status line has been sent, the
+        connection is dropped, since the client would otherwise take the
+        partial message as complete.
+        '''
+        await self.push(status)
+        encoder = MultilineEncoder()
+        size = 0
+        try:
+            async for data in chunks:
+                size += len(data)
+                for chunk in encoder.feed(data):
+                    self._write(chunk)
+                    await self._drain_if_needed()
+        except Exception:
+            log.exception('%s Aborting after %s bytes', self.peer_str, size)
+            self._handler_coroutine.cancel()
+            self.transport.abort()
+            return
+        log.debug('%s (%s bytes)', self.peer_str, size)
+        self._write(encoder.finish())
+        await self._drain_if_needed()
+
+    async def push_file(self, status, fp):
+        '''Send *status* followed by the contents of the binary file *fp*,
+        which must already be in multiline format, terminator included.
+
+        The file is sent with loop.sendfile, which uses os.sendfile when
+        the transport allows it, and reads the file in chunks otherwise
+        (for instance over TLS). Event loops without loop.sendfile, such
+        as uvloop, get the file in chunks read in an executor.
+        '''
+        log.debug('%s %r', self.peer_str, status)
+        self._write((status + '\r\n').encode('ascii'))
+        self._flush_buffer()
+        offset = fp.tell()
+        try:
+            size = await self.loop.sendfile(self.transport, fp)
+        except NotImplementedError:
+            fp.seek(offset)
+            size = await self._push_file_chunks(fp)
+            log.debug('%s (%s bytes from file in chunks)', self.peer_str,
+                      size)
+            return
+        self.bytes_out += size
+        self.writes += 1
+        Pop3.writes_total += 1
+        log.debug('%s (%s bytes from file)', self.peer_str, size)
+
+    async def _push_file_chunks(self, fp):
+        size = 0
+        while True:
+            data = await self.loop.run_in_executor(None, fp.read,
+                                                   DRAIN_THRESHOLD)
+            if not data:
+                return size
+            size += len(data)
+            self._write(data)
+            await self._drain_if_needed()
 
     async def handle_exception(self, error):
         if hasattr(self.event_handler, 'handle_exception'):
@@ -100,29 +403,17 @@ class Pop3(asyncio.StreamReaderProtocol):
             self.state = 'AUTHORIZATION'
             await self.push('+OK {} {}'.format(self.hostname, self.__ident__))
             while self.transport is not None:
-                line = await self._reader.readline()
-                log.debug('%s %s', self.peer_str, line.split()[0])
-                line = line.rstrip(b'\r\n')
-                if not line:
-                    await self.push('-ERR Error: bad syntax')
-                    continue
-                line = line.decode('ascii')
-                try:
-                    command, arg = line.split(' ', 1)
-                except ValueError:
-                    command, arg = line, None
-                method = getattr(self, 'pop3_' + command, None)
-                method_state = getattr(method, 'command_state', None)
-                if method_state is not None and method_state != self.state:
-                    await self.push(
-                        '-ERR wrong state for "%s"' % command)
-                    continue
-                if method is None:
-                    await self.push(
-                        '-ERR command "%s" not recognized' % command)
+                line = await self._readline()
+                if line is None:
+                    await self.push('-ERR line too long')
                     continue
-                await method(arg)
+                if line is TIMED_OUT:
+                    await self._time_out()
+                    break
+                await self._handle_line(line)
         except asyncio.CancelledError:
+            if self.transport is not None:
+                self._flush_buffer()
             self._writer.close()
         except Exception as error:
             try:
@@ -134,7 +425,70 @@ class Pop3(asyncio.StreamReaderProtocol):
                         error.__class__.__name__, str(error))
                 except Exception:
                     status = '-ERR Error: Cannot describe error'
-            await self.push(status)
+            # The session cannot go on; close it, which also gives up its
+            # place in self.limits
+            try:
+                if self.transport is not None:
+                    await self.push(status)
+                    await self.flush()
+            finally:
+                if self.transport is not None:
+                    self.transport.close()
+
+    async def _time_out(self):
+        # Close the session without entering the UPDATE state
+        if self.state == 'AUTHORIZATION':
+            self.limits.auth_timeouts += 1
+            status = '-ERR timed out waiting for login'
+        else:
+            self.limits.idle_timeouts += 1
+            status = '-ERR autologout; idle for too long'
+        log.info('%s %s', self.peer_str, status)
+        await self.push(status)
+        self._flush_buffer()
+        self.transport.close()
+
+    async def _handle_line(self, line):
+        verb, sep, arg = line.rstrip(b'\r\n').partition(b' ')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s %r', self.peer_str, verb)
+        if not verb:
+            await self.push('-ERR Error: bad syntax')
+            return
+        key = verb.upper()
+        entry = self._dispatch.get(key)
+        if entry is None:
+            await self.push('-ERR command "%s" not recognized' %
+                            verb.decode('ascii', 'backslashreplace'))
+            return
+        method, state = entry
+        if state is not None and state != self.state:
+            await self.push('-ERR wrong state for "%s"' % verb.decode('ascii'))
+            return
+        if sep:
+            try:
+                arg = arg.decode('ascii')
+            except UnicodeDecodeError:
+                await self.push('-ERR Error: non-ASCII argument')
+                return
+        else:
+            arg = None
+        self.commands += 1
+        Pop3.commands_total += 1
+        if self.metrics is None:
+            await method(self, arg)
+            return
+        histogram = self.metrics.command(key)
+        start = self.loop.time()
+        try:
+            await method(self, arg)
+        finally:
+            histogram.observe(self.loop.time() - start)
+
+    @classmethod
+    def stats(cls):
+        return dict(commands=cls.commands_total, writes=cls.writes_total,
+                    tls_full=cls.tls_full, tls_resumed=cls.tls_resumed)
 
     @staticmethod
     def parse_message_number(arg):
@@ -151,10 +505,12 @@ class Pop3(asyncio.StreamReaderProtocol):
             return
         status = await self._call_handler_hook('CAPA')
         if status is MISSING:
-            # PIPELINING?
             caps = [
                 b'USER',
                 b'UIDL',
+                b'PIPELINING',
+                b'RESP-CODES',
+                b'AUTH-RESP-CODE',
             ]
             if hasattr(self.event_handler, 'handle_TOP'):
                 caps.append(b'TOP')
@@ -192,7 +548,11 @@ class Pop3(asyncio.StreamReaderProtocol):
             status = '+OK'
         if status.startswith('+OK'):
             log.info('%s Logged in as %r', self.peer_str, self.username)
+            if self.metrics is not None:
+                self.metrics.logins_ok += 1
         else:
+            if self.metrics is not None:
+                self.metrics.logins_failed += 1
             log.warning('%s Login attempt as %r failed: %r', self.peer_str, username, status)
         await self.push(status)
 
@@ -209,6 +569,7 @@ class Pop3(asyncio.StreamReaderProtocol):
             return
         status = await self._call_handler_hook('QUIT')
         await self.push('+OK Bye' if status is MISSING else status)
+        self._flush_buffer()
         self._handler_coroutine.cancel()
         self.transport.close()
 
@@ -220,24 +581,41 @@ class Pop3(asyncio.StreamReaderProtocol):
         status = await self._call_handler_hook('STAT')
         await self.push('+OK 0 0' if status is MISSING else status)
 
+    async def _scan_listing(self, command):
+        # Return (n, value) pairs for every message that is not deleted,
+        # or MISSING if the handler implements neither hook. Handlers may
+        # implement handle_<command>_all to produce the whole listing in one
+        # call; otherwise handle_<command> is called for n = 1, 2, ...
+        # until it raises IndexError.
+        entries = await self._call_handler_hook(command + '_all')
+        if entries is not MISSING:
+            return entries
+        entries = []
+        n = 1
+        while True:
+            try:
+                value = await self._call_handler_hook(command, n)
+            except IndexError:
+                break
+            if value is MISSING:
+                return MISSING
+            if value is not None and value != '':
+                entries.append((n, value))
+            n += 1
+        return entries
+
+    async def push_listing(self, status, entries):
+        data = ''.join('%s %s\r\n' % e for e in entries).encode('ascii')
+        await self.push_multi(status, data)
+
     @command('TRANSACTION')
     async def pop3_LIST(self, arg):
         if arg is None:
-            n = 1
-            status = '+OK scan listing follows'
-            lines = []
-            while True:
-                try:
-                    size = await self._call_handler_hook('LIST', n)
-                except IndexError:
-                    break
-                if size is MISSING:
-                    await self.push('-ERR not implemented')
-                    return
-                if size is not None:
-                    lines.append(('%s %s' % (n, size)).encode('ascii'))
-                n += 1
-            await self.push_multi(status, lines)
+            entries = await self._scan_listing('LIST')
+            if entries is MISSING:
+                await self.push('-ERR not implemented')
+                return
+            await self.push_listing('+OK scan listing follows', entries)
         else:
             try:
                 n = self.parse_message_number(arg)
@@ -257,21 +635,11 @@ class Pop3(asyncio.StreamReaderProtocol):
     @command('TRANSACTION')
     async def pop3_UIDL(self, arg):
         if arg is None:
-            n = 1
-            status = '+OK unique-id listing follows'
-            lines = []
-            while True:
-                try:
-                    uid = await self._call_handler_hook('UIDL', n)
-                except IndexError:
-                    break
-                if uid is MISSING:
-                    await self.push('-ERR not implemented')
-                    return
-                if uid:
-                    lines.append(('%s %s' % (n, uid)).encode('ascii'))
-                n += 1
-            await self.push_multi(status, lines)
+            entries = await self._scan_listing('UIDL')
+            if entries is MISSING:
+                await self.push('-ERR not implemented')
+                return
+            await self.push_listing('+OK unique-id listing follows', entries)
         else:
             try:
                 n = self.parse_message_number(arg)
@@ -297,10 +665,14 @@ class Pop3(asyncio.StreamReaderProtocol):
         except ValueError:
             await self.push('-ERR Syntax: RETR <n>')
             return
+        start = self.bytes_out
         try:
             status = await self._call_handler_hook('RETR', n)
         except IndexError:
             status = '-ERR no such message'
+        if status is None and self.metrics is not None:
+            # The handler sent the message
+            self.metrics.retr_bytes.observe(self.bytes_out - start)
         if status is not None:
             await self.push('-ERR no such message'
                             if status is MISSING else status)
@@ -344,6 +716,13 @@ class Pop3(asyncio.StreamReaderProtocol):
         except ValueError:
             await self.push('-ERR Syntax: TOP <n> <lines>')
             return
-        status = await self._call_handler_hook('TOP', n, lines)
-        if status is MISSING:
-            await self.push('-ERR TOP not implemented')
+        try:
+            status = await self._call_handler_hook('TOP', n, lines)
+        except IndexError:
+            status = '-ERR no such message'
+        if status is not None:
+            await self.push('-ERR TOP not implemented'
+                            if status is MISSING else status)
+
+
+Pop3._dispatch = Pop3._build_dispatch()
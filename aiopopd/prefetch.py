@@ -0,0 +1,126 @@
+import asyncio
+
+from aiopopd.pop import log
+
+
+class ByteBudget:
+    'Upper bound on the bytes of message data held by prefetchers at once.'
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, n):
+        if self.used + n > self.limit:
+            return False
+        self.used += n
+        return True
+
+    def release(self, n):
+        self.used -= n
+
+    def stats(self):
+        return dict(limit=self.limit, used=self.used)
+
+
+class Prefetcher:
+    '''Fetch the next messages of a session while the current one is sent.
+
+    POP3 clients such as Gmail retrieve messages in order, so once a RETR
+    follows the previous one (or is RETR 1), the bodies of the next *depth*
+    messages are fetched in the background. Every prefetched body is
+    charged to the session's own budget of *session_bytes* and to the
+    *shared* ByteBudget of the process until it is retrieved or discarded.
+    Messages larger than *max_size*, or whose UID *is_cached* returns true
+    for, are never prefetched. Bodies are fetched by calling *fetch* with
+    the UID and size of the message.
+    '''
+
+    def __init__(self, fetch, depth, session_bytes, shared=None,
+                 max_size=None, is_cached=None):
+        self._fetch = fetch
+        self.depth = depth
+        self.max_size = max_size
+        self.is_cached = is_cached
+        self._session = ByteBudget(session_bytes)
+        self._shared = shared
+        self._pending = {}
+        self._last = None
+        self.hits = self.misses = 0
+
+    async def retrieve(self, messages, n):
+        'Return the body of message *n* in the MessageTable *messages*.'
+        sequential = self._access(n)
+        entry = self._pending.pop(n, None)
+        body = None
+        if entry is not None:
+            task, size = entry
+            try:
+                body = await task
+                self.hits += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Prefetch of message %s failed', n)
+            finally:
+                self._release(size)
+        if body is None:
+            self.misses += 1
+            body = await self._fetch(messages.uid(n), messages.size(n))
+        if sequential:
+            self._schedule(messages, n)
+        return body
+
+    def skip(self, messages, n):
+        'Note that message *n* is being retrieved without the prefetcher.'
+        if self._access(n):
+            self._schedule(messages, n)
+
+    def _access(self, n):
+        sequential = n == 1 if self._last is None else n == self._last + 1
+        self._last = n
+        if not sequential:
+            self.cancel()
+        return sequential
+
+    def _schedule(self, messages, n):
+        for m in range(n + 1, min(n + self.depth, len(messages)) + 1):
+            if m in self._pending or messages.is_deleted(m):
+                continue
+            size = messages.size(m)
+            if self.max_size is not None and size > self.max_size:
+                continue
+            if self.is_cached is not None and self.is_cached(messages.uid(m)):
+                continue
+            if not self._session.reserve(size):
+                break
+            if self._shared is not None and not self._shared.reserve(size):
+                self._session.release(size)
+                break
+            task = asyncio.ensure_future(self._fetch(messages.uid(m), size))
+            self._pending[m] = (task, size)
+
+    def _release(self, size):
+        self._session.release(size)
+        if self._shared is not None:
+            self._shared.release(size)
+
+    def cancel(self):
+        '''Discard all prefetched and in-flight messages.
+
+        A FETCH that is already running is left to finish, since abandoning
+        it halfway would leave its response on the IMAP connection; its
+        bytes stay charged to the budgets until then.
+        '''
+        for task, size in self._pending.values():
+            if task.done():
+                self._discard(task, size)
+            else:
+                task.add_done_callback(
+                    lambda task, size=size: self._discard(task, size))
+        self._pending.clear()
+
+    def _discard(self, task, size):
+        if not task.cancelled():
+            task.exception()
+        self._release(size)
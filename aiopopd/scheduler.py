@@ -0,0 +1,242 @@
+import time
+import asyncio
+import collections
+
+
+class HostBusy(Exception):
+    'Waited too long for a connection to or a command on an IMAP host.'
+
+
+class FairSemaphore:
+    '''At most *limit* holders at once, with the waiters of each owner
+    served in turn (round-robin between owners, in order within one).'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        # owner -> deque of futures; the next owner to be served first
+        self._waiters = collections.OrderedDict()
+        self.waiting = 0
+
+    def full(self):
+        return self.active >= self.limit
+
+    async def acquire(self, owner, timeout):
+        'Wait for the semaphore; return the seconds waited.'
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return 0.0
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(owner, collections.deque()).append(future)
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException:
+            if future.done():
+                # Granted just as we gave up; pass it on
+                self.release()
+            else:
+                future.cancel()
+                self._remove(owner, future)
+            raise
+        return time.monotonic() - start
+
+    def _remove(self, owner, future):
+        self.waiting -= 1
+        waiters = self._waiters[owner]
+        waiters.remove(future)
+        if not waiters:
+            del self._waiters[owner]
+
+    def release(self):
+        if self._waiters:
+            owner, waiters = self._waiters.popitem(last=False)
+            future = waiters.popleft()
+            self.waiting -= 1
+            if waiters:
+                # Let the other owners go before this one's next waiter
+                self._waiters[owner] = waiters
+            # The semaphore passes straight to the waiter
+            future.set_result(None)
+        else:
+            self.active -= 1
+
+    def idle(self):
+        return not self.active and not self._waiters
+
+
+class _Host:
+    __slots__ = ('connections', 'commands')
+
+    def __init__(self, max_connections, max_commands):
+        self.connections = self.commands = None
+        if max_connections:
+            self.connections = FairSemaphore(max_connections)
+        if max_commands:
+            self.commands = FairSemaphore(max_commands)
+
+    def idle(self):
+        return all(s is None or s.idle()
+                   for s in (self.connections, self.commands))
+
+
+class _Wait:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class HostScheduler:
+    '''Limits on the IMAP connections and commands to each host.
+
+    At most *max_connections* connections to one host are open at once,
+    counting those kept by a BackendPool, and at most *max_commands*
+    commands run on them at once (IDLE and LOGOUT are not counted). 0 means
+    no limit. Sessions waiting for a connection or a command are served
+    round-robin between POP3 users, so one user with many sessions cannot
+    hold up the others, and give up with HostBusy after *queue_timeout*
+    seconds.
+    '''
+
+    def __init__(self, max_connections=0, max_commands=0, queue_timeout=30):
+        self.max_connections = max_connections
+        self.max_commands = max_commands
+        self.queue_timeout = queue_timeout
+        self._hosts = {}
+        self.connection_waits = _Wait()
+        self.command_waits = _Wait()
+        self.timeouts = 0
+
+    def _host(self, host):
+        try:
+            return self._hosts[host]
+        except KeyError:
+            state = self._hosts[host] = _Host(self.max_connections,
+                                              self.max_commands)
+            return state
+
+    def _forget(self, host):
+        state = self._hosts.get(host)
+        if state is not None and state.idle():
+            del self._hosts[host]
+
+    def connections_full(self, host):
+        'True if a new connection to *host* would have to wait.'
+        state = self._hosts.get(host)
+        return (state is not None and state.connections is not None and
+                state.connections.full())
+
+    def connections_wanted(self, host):
+        'True if sessions are waiting for a connection to *host*.'
+        state = self._hosts.get(host)
+        return (state is not None and state.connections is not None and
+                state.connections.waiting > 0)
+
+    async def _acquire(self, host, kind, owner, waits):
+        if not getattr(self, 'max_' + kind):
+            return False
+        semaphore = getattr(self._host(host), kind)
+        try:
+            waited = await semaphore.acquire(owner, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._forget(host)
+            raise HostBusy('IMAP server %s is busy, try again later' % host)
+        except BaseException:
+            self._forget(host)
+            raise
+        waits.add(waited)
+        return True
+
+    def _release(self, host, kind):
+        getattr(self._hosts[host], kind).release()
+        self._forget(host)
+
+    def wrap(self, backend, host, owner):
+        'Return *backend*, which is to connect to *host* for *owner*, limited.'
+        if not self.max_connections and not self.max_commands:
+            return backend
+        return ScheduledBackend(self, backend, host, owner)
+
+    def stats(self):
+        result = dict(hosts=len(self._hosts), timeouts=self.timeouts)
+        for kind, waits in (('connections', self.connection_waits),
+                            ('commands', self.command_waits)):
+            semaphores = [getattr(state, kind)
+                          for state in self._hosts.values()]
+            semaphores = [s for s in semaphores if s is not None]
+            result[kind] = sum(s.active for s in semaphores)
+            result[kind + '_queued'] = sum(s.waiting for s in semaphores)
+            result[kind + '_wait_avg'] = (waits.total / waits.count
+                                          if waits.count else 0.0)
+            result[kind + '_wait_max'] = waits.max
+        return result
+
+
+class ScheduledBackend:
+    '''An IMAP backend holding a connection slot of its host from connect()
+    until disconnect() or connection_lost(), and a command slot for each
+    command.'''
+
+    # Commands that do not take a command slot: IDLE waits for the server
+    # for a long time, and closing a connection should never wait.
+    UNLIMITED = frozenset(['idle', 'idle_check', 'idle_done', 'logout'])
+
+    def __init__(self, scheduler, backend, host, owner):
+        self._scheduler = scheduler
+        self._backend = backend
+        self._host = host
+        self._owner = owner
+        self._connected = False
+
+    async def connect(self):
+        self._connected = await self._scheduler._acquire(
+            self._host, 'connections', self._owner,
+            self._scheduler.connection_waits)
+        try:
+            await self._backend.connect()
+        except BaseException:
+            self._release_connection()
+            raise
+
+    def _release_connection(self):
+        if self._connected:
+            self._connected = False
+            self._scheduler._release(self._host, 'connections')
+
+    def connection_lost(self):
+        self._backend.connection_lost()
+        self._release_connection()
+
+    async def disconnect(self):
+        try:
+            await self._backend.disconnect()
+        finally:
+            self._release_connection()
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name in self.UNLIMITED or not asyncio.iscoroutinefunction(attr):
+            return attr
+        scheduler = self._scheduler
+        host = self._host
+        owner = self._owner
+
+        async def limited(*args, **kwargs):
+            acquired = await scheduler._acquire(
+                host, 'commands', owner, scheduler.command_waits)
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                if acquired:
+                    scheduler._release(host, 'commands')
+
+        return limited
@@ -1,36 +1,51 @@
 import os
-import json
 import time
+import asyncio
+import socket
+import sqlite3
 import logging
 import argparse
-from aiopopd.pop import Pop3
-from aiopopd.imap import ImapHandler, ImapBackend
-from aiopopd.controller import Controller
-from aiopopd.main import get_ssl_context, SystemdFormatter
+import functools
+from aiopopd.pop import Pop3, SessionLimits, MAX_LINE_LENGTH
+from aiopopd.imap import ImapHandler, BACKENDS
+from aiopopd.imap_backend import ImapWorkerPool
+from aiopopd.index import IndexStore
+from aiopopd.pool import BackendPool
+from aiopopd.prefetch import ByteBudget
+from aiopopd.spool import Spool
+from aiopopd.users import UserDirectory
+from aiopopd.auth import AuthGuard
+from aiopopd.scheduler import HostScheduler
+from aiopopd.deadline import Deadlines
+from aiopopd.metrics import Metrics, start_metrics_server
+from aiopopd.controller import (
+    Controller, Prefork, drop_privileges, reuse_port_sockets, LOOPS, PROFILES, new_event_loop,
+    configure_loop)
+from aiopopd.main import get_ssl_context, SystemdFormatter, KEY_TYPES
 
 
 class ImapHandlerFile(ImapHandler):
-    def __init__(self, path, **kwargs):
+    def __init__(self, users, **kwargs):
         super().__init__(**kwargs)
-        self.path = path
+        self.users = users
 
     async def get_backend(self, username, password):
-        if '/' in username or username.startswith('.'):
-            raise ValueError('invalid username')
-        try:
-            with open(os.path.join(self.path, username)) as fp:
-                config = json.load(fp)
-        except FileNotFoundError:
+        config = await self.users.get(username)
+        if config is None:
             raise ValueError('unknown username')
-        backend = ImapBackend(loop=self.loop, host=config['hostname'],
-                              port=config['port'], ssl=config.get('ssl', True))
-        await backend.connect()
-        await backend.login(config.get('username', username), password)
-        return backend
+        return await self.open_backend(
+            config['hostname'], config['port'], config.get('ssl', True),
+            config.get('username', username), password)
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-p', '--path', required=True)
+parser.add_argument('-p', '--path', required=True,
+                    help='Directory of JSON files named after the users, ' +
+                    'JSON file or SQLite database of the users')
+parser.add_argument('--path-check-interval', type=float, default=5,
+                    metavar='SECONDS',
+                    help='How often to check --path for changes ' +
+                    '(default: %(default)s)')
 parser.add_argument('-r', '--listen-all', action='store_true')
 parser.add_argument('-P', '--listen-port', required=True, type=int)
 parser.add_argument('-n', '--no-setuid', action='store_false', dest='setuid')
@@ -39,6 +54,132 @@ parser.add_argument('-d', '--hostname')
 parser.add_argument('--ssl-key')
 parser.add_argument('--ssl-cert')
 parser.add_argument('--ssl-generate', action='store_true')
+parser.add_argument('--ssl-key-type', choices=sorted(KEY_TYPES), default='rsa',
+                    help='Key type of the certificate made by ' +
+                    '--ssl-generate (default: %(default)s)')
+parser.add_argument('--ssl-tickets', type=int, default=2,
+                    help='TLS session tickets sent per connection, so ' +
+                    'reconnecting clients can resume the session; 0 ' +
+                    'disables tickets (default: %(default)s)')
+parser.add_argument('--imap-backend', choices=sorted(BACKENDS),
+                    default='thread')
+parser.add_argument('--loop', choices=LOOPS, default='asyncio',
+                    help='Event loop implementation (default: %(default)s)')
+parser.add_argument('--loop-profile', choices=PROFILES, default='production',
+                    help='"debug" turns on asyncio debug mode ' +
+                    '(default: %(default)s)')
+parser.add_argument('--imap-workers', type=int, default=0,
+                    help='Share this many threads between all IMAP ' +
+                    'connections instead of one thread per connection')
+parser.add_argument('--index-path',
+                    help='Directory in which to keep a message index of ' +
+                    'each mailbox, so logins only fetch new messages')
+parser.add_argument('--search-criteria', default=ImapHandler.search_criteria,
+                    help='IMAP SEARCH criteria for the messages to offer ' +
+                    '(default: %(default)s)')
+parser.add_argument('--prefetch', type=int, default=0, metavar='K',
+                    help='When messages are retrieved in order, fetch the ' +
+                    'next K messages in the background')
+parser.add_argument('--prefetch-session-mb', type=float, default=32,
+                    help='Prefetched bytes held per session (MB, ' +
+                    'default: %(default)s)')
+parser.add_argument('--prefetch-total-mb', type=float, default=256,
+                    help='Prefetched bytes held by all sessions (MB, ' +
+                    'default: %(default)s)')
+parser.add_argument('--stream-threshold-kb', type=int,
+                    default=ImapHandler.stream_threshold // 1024,
+                    help='Send larger messages while they are fetched ' +
+                    'instead of holding them in memory; 0 disables ' +
+                    '(default: %(default)s)')
+parser.add_argument('--stream-chunk-kb', type=int,
+                    default=ImapHandler.stream_chunk_size // 1024,
+                    help='Size of each partial fetch of a streamed message ' +
+                    '(default: %(default)s)')
+parser.add_argument('--spool-path',
+                    help='Directory in which to keep retrieved messages, ' +
+                    'so retrieving them again does not need IMAP')
+parser.add_argument('--spool-mb', type=float, default=1024,
+                    help='Size of the spool directory (MB, ' +
+                    'default: %(default)s); with --workers, each worker ' +
+                    'spools to a subdirectory of its own')
+parser.add_argument('--pool-idle', type=float, default=0, metavar='SECONDS',
+                    help='Keep IMAP connections logged in for this long ' +
+                    'after QUIT, for the next login of the same user')
+parser.add_argument('--pool-max-per-host', type=int, default=20,
+                    help='Most IMAP connections kept per host ' +
+                    '(default: %(default)s)')
+parser.add_argument('--pool-warm', action='store_true',
+                    help='Keep pooled IMAP connections in IDLE, keeping ' +
+                    'the message index current for the next login ' +
+                    '(requires --pool-idle and --index-path)')
+parser.add_argument('--auth-failure-ttl', type=float, default=60,
+                    metavar='SECONDS',
+                    help='Refuse a username and password that the IMAP ' +
+                    'server rejected for this long without asking it ' +
+                    'again; 0 disables (default: %(default)s)')
+parser.add_argument('--login-rate-user', type=float, default=0,
+                    metavar='PER_MINUTE',
+                    help='Logins per minute allowed for each user, in ' +
+                    'bursts of up to this many; 0 disables')
+parser.add_argument('--login-rate-peer', type=float, default=0,
+                    metavar='PER_MINUTE',
+                    help='Logins per minute allowed from each client ' +
+                    'address, in bursts of up to this many; 0 disables')
+parser.add_argument('--host-max-connections', type=int, default=0,
+                    help='Most connections open to one IMAP host, ' +
+                    'including pooled ones, per worker; 0 for no limit')
+parser.add_argument('--host-max-commands', type=int, default=0,
+                    help='Most commands running at once on one IMAP host, ' +
+                    'per worker; 0 for no limit')
+parser.add_argument('--host-queue-timeout', type=float, default=30,
+                    metavar='SECONDS',
+                    help='How long a session waits for a connection or ' +
+                    'command slot before giving up (default: %(default)s)')
+parser.add_argument('--imap-connect-timeout', type=float, default=30,
+                    metavar='SECONDS',
+                    help='Deadline for connecting to the IMAP server; ' +
+                    'a connection missing a deadline is closed, and 0 ' +
+                    'disables a deadline (default: %(default)s)')
+parser.add_argument('--imap-login-timeout', type=float, default=30,
+                    metavar='SECONDS',
+                    help='Deadline for IMAP LOGIN (default: %(default)s)')
+parser.add_argument('--imap-select-timeout', type=float, default=60,
+                    metavar='SECONDS',
+                    help='Deadline for IMAP SELECT (default: %(default)s)')
+parser.add_argument('--imap-command-timeout', type=float, default=60,
+                    metavar='SECONDS',
+                    help='Deadline for other IMAP commands ' +
+                    '(default: %(default)s)')
+parser.add_argument('--imap-fetch-timeout-per-mb', type=float, default=10,
+                    metavar='SECONDS',
+                    help='Time added to the deadline of a FETCH per MB ' +
+                    'fetched (default: %(default)s)')
+parser.add_argument('--max-sessions', type=int, default=0,
+                    help='Most POP3 sessions served at once, per worker; ' +
+                    'more are refused with -ERR [SYS/TEMP]; 0 for no limit')
+parser.add_argument('--max-sessions-per-peer', type=int, default=0,
+                    help='Most POP3 sessions from one client address, ' +
+                    'per worker; 0 for no limit')
+parser.add_argument('--auth-timeout', type=float, default=60,
+                    metavar='SECONDS',
+                    help='Disconnect clients that have not logged in this ' +
+                    'long after connecting; 0 disables (default: %(default)s)')
+parser.add_argument('--idle-timeout', type=float, default=600,
+                    metavar='SECONDS',
+                    help='Disconnect logged in clients idle for this long, ' +
+                    'without deleting messages; 0 disables ' +
+                    '(default: %(default)s)')
+parser.add_argument('--max-line-length', type=int, default=MAX_LINE_LENGTH,
+                    help='Longest POP3 command line accepted ' +
+                    '(default: %(default)s)')
+parser.add_argument('--metrics-port', type=int, default=0,
+                    help='Serve Prometheus metrics over HTTP on this port ' +
+                    '(the Nth of several workers on the port plus N)')
+parser.add_argument('--metrics-host', default='127.0.0.1',
+                    help='Address to serve the metrics on')
+parser.add_argument('--workers', type=int, default=0,
+                    help='Serve from this many processes sharing the ' +
+                    'port with SO_REUSEPORT, restarting any that crash')
 
 
 def main():
@@ -52,25 +193,177 @@ def main():
         handler, = logging.getLogger().handlers
         handler.setFormatter(SystemdFormatter())
 
-    def factory():
-        return Pop3(ImapHandlerFile(args.path), hostname=args.hostname)
-
-    hostname = '0.0.0.0' if args.listen_all else '::1'
-    controller = Controller(None, hostname=hostname, port=args.listen_port,
-                            ssl_context=ssl_context, setuid=args.setuid)
-    controller.factory = factory
-    controller.loop.set_debug(enabled=True)
+    if args.imap_workers and args.imap_backend != 'thread':
+        raise SystemExit('--imap-workers requires --imap-backend thread')
+    if args.pool_warm:
+        if not args.pool_idle or not args.index_path:
+            raise SystemExit('--pool-warm requires --pool-idle and ' +
+                             '--index-path')
+        if args.imap_workers:
+            # IDLE would keep the shared threads busy
+            raise SystemExit('--pool-warm cannot be used with --imap-workers')
+    if args.loop == 'uvloop':
+        try:
+            new_event_loop(args.loop).close()
+        except ValueError as exn:
+            raise SystemExit(str(exn))
     try:
+        # Loaded before forking, so each worker starts with the users
+        users = UserDirectory(args.path, args.path_check_interval)
+    except (OSError, ValueError, sqlite3.Error) as exn:
+        raise SystemExit('Cannot load users from %s: %s' % (args.path, exn))
+    hostname = '0.0.0.0' if args.listen_all else '::1'
+    # One per worker, bound before anything drops privileges
+    metrics_sockets = []
+    for i in range(max(args.workers, 1) if args.metrics_port else 0):
+        port = args.metrics_port + i
+        try:
+            metrics_sockets.append(
+                socket.create_server((args.metrics_host, port)))
+        except OSError as exn:
+            raise SystemExit('Cannot serve metrics on %s:%s: %s' %
+                             (args.metrics_host, port, exn))
+
+    def serve(sock):
+        # Everything holding threads, connections or caches is created
+        # here, in the worker process when there are several.
+        backend_class = BACKENDS[args.imap_backend]
+        metrics = None
+        if args.metrics_port:
+            metrics = Metrics()
+            backend_class = functools.partial(backend_class, metrics=metrics)
+        pool = None
+        if args.imap_workers:
+            pool = ImapWorkerPool(args.imap_workers)
+            backend_class = functools.partial(backend_class, executor=pool)
+
+        index_store = None
+        if args.index_path:
+            index_store = IndexStore(args.index_path)
+
+        prefetch_budget = None
+        if args.prefetch:
+            prefetch_budget = ByteBudget(int(args.prefetch_total_mb * 1e6))
+
+        spool = None
+        if args.spool_path:
+            # Each worker fills its share of the size in a directory of its
+            # own, so that none evicts the files of another
+            spool_path = args.spool_path
+            if args.workers:
+                spool_path = os.path.join(spool_path,
+                                          str(sockets.index(sock)))
+            spool = Spool(spool_path,
+                          int(args.spool_mb * 1e6 / max(args.workers, 1)))
+
+        backend_pool = None
+        if args.pool_idle:
+            backend_pool = BackendPool(args.pool_idle, args.pool_max_per_host,
+                                       warm=args.pool_warm)
+
+        limits = SessionLimits(args.max_sessions, args.max_sessions_per_peer,
+                               args.auth_timeout or None,
+                               args.idle_timeout or None, args.max_line_length)
+
+        deadlines = Deadlines(args.imap_connect_timeout or None,
+                              args.imap_login_timeout or None,
+                              args.imap_select_timeout or None,
+                              args.imap_command_timeout or None,
+                              args.imap_fetch_timeout_per_mb or None)
+
+        scheduler = None
+        if args.host_max_connections or args.host_max_commands:
+            scheduler = HostScheduler(args.host_max_connections,
+                                      args.host_max_commands,
+                                      args.host_queue_timeout)
+
+        # Each worker keeps its own failures and limits
+        auth_guard = AuthGuard(
+            args.auth_failure_ttl,
+            args.login_rate_user / 60, max(args.login_rate_user, 1),
+            args.login_rate_peer / 60, max(args.login_rate_peer, 1))
+
+        def factory():
+            handler = ImapHandlerFile(
+                users, backend_class=backend_class,
+                index_store=index_store, search_criteria=args.search_criteria,
+                prefetch_depth=args.prefetch,
+                prefetch_session_bytes=int(args.prefetch_session_mb * 1e6),
+                prefetch_budget=prefetch_budget,
+                stream_threshold=args.stream_threshold_kb * 1024,
+                stream_chunk_size=args.stream_chunk_kb * 1024, spool=spool,
+                backend_pool=backend_pool, auth_guard=auth_guard,
+                scheduler=scheduler, deadlines=deadlines)
+            return Pop3(handler, hostname=args.hostname, limits=limits,
+                        metrics=metrics)
+
+        # (log title, metrics name, stats function)
+        stats = [('POP3', 'pop3', Pop3.stats),
+                 ('Sessions', 'limits', limits.stats),
+                 ('Users', 'users', users.stats),
+                 ('Logins', 'auth', auth_guard.stats),
+                 ('IMAP deadlines', 'imap_deadlines', deadlines.stats)]
+        if ssl_context is not None:
+            stats.append(('TLS sessions', 'tls_sessions',
+                          ssl_context.session_stats))
+        for title, name, obj in (
+                ('IMAP worker pool', 'imap_workers', pool),
+                ('Prefetch budget', 'prefetch', prefetch_budget),
+                ('Spool', 'spool', spool),
+                ('IMAP connection pool', 'imap_pool', backend_pool),
+                ('IMAP hosts', 'imap_hosts', scheduler)):
+            if obj is not None:
+                stats.append((title, name, obj.stats))
+
+        metrics_sock = None
+        if metrics is not None:
+            for title, name, fn in stats:
+                metrics.add_stats(name, fn)
+            metrics_sock = metrics_sockets[sockets.index(sock)]
+
+        loop = new_event_loop(args.loop)
+        configure_loop(loop, args.loop_profile)
+        controller = Controller(None, loop=loop, hostname=hostname,
+                                port=args.listen_port, ssl_context=ssl_context,
+                                sock=sock)
+        controller.factory = factory
         controller.start()
+        if metrics_sock is not None:
+            start_metrics_server(metrics, loop, metrics_sock)
+            log.info('Metrics on http://%s:%s/metrics',
+                     *metrics_sock.getsockname()[:2])
+        try:
+            while True:
+                time.sleep(60)
+                for title, name, fn in stats:
+                    log.info('%s: %s', title, fn())
+        except KeyboardInterrupt:
+            pass
+        if backend_pool is not None:
+            # Pooled connections hold threads that would keep the process
+            # from exiting, and cannot be closed once the loop has stopped
+            asyncio.run_coroutine_threadsafe(
+                backend_pool.close(), loop).result()
+        controller.stop()
+
+    # Bound here in either mode, so that privileges are dropped before
+    # serve() creates the index and spool directories
+    sockets = reuse_port_sockets(hostname, args.listen_port,
+                                 max(args.workers, 1))
+    if not args.workers:
+        try:
+            if args.setuid:
+                drop_privileges()
+        except PermissionError:
+            raise SystemExit(
+                'Cannot setuid "nobody"; try running with -n option.')
+        serve(sockets[0])
+        return
+    try:
+        Prefork(sockets, serve, setuid=args.setuid).run()
     except PermissionError:
         raise SystemExit(
             'Cannot setuid "nobody"; try running with -n option.')
-    try:
-        while True:
-            time.sleep(60)
-    except KeyboardInterrupt:
-        pass
-    controller.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+import os
+import asyncio
+import hashlib
+import itertools
+import collections
+
+from aiopopd.encoder import MultilineEncoder
+from aiopopd.pop import log
+
+
+# Every message in the spool ends with the multiline terminator
+TRAILER = b'\r\n.\r\n'
+
+
+class Spool:
+    '''Size-bounded directory of messages in POP3 wire format.
+
+    Messages are keyed by (host, user, UIDVALIDITY, UID) and stored
+    CRLF-normalized and dot-stuffed, followed by the terminating line, so a
+    RETR can be answered by sending the file as is. Files are written to a
+    temporary name and renamed, and the size and trailer of a file are
+    checked before it is served. Once the spool holds more than *max_bytes*,
+    the least recently used messages are removed. Each process should have
+    a directory of its own, as every file in it counts against its size.
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._tmp_names = itertools.count()
+        self.size = 0
+        self.hits = self.misses = self.stores = 0
+        self.evictions = self.corrupt = 0
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # Pick up the messages spooled by an earlier process, least
+        # recently written first.
+        found = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.tmp'):
+                if not _writer_running(entry.name):
+                    os.unlink(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def filename(key):
+        return hashlib.sha256('\0'.join(map(str, key)).encode()).hexdigest()
+
+    def __contains__(self, key):
+        return self.filename(key) in self._entries
+
+    def open(self, key):
+        'Return the spooled message as an open binary file, or None.'
+        name = self.filename(key)
+        size = self._entries.get(name)
+        if size is None:
+            self.misses += 1
+            return None
+        try:
+            fp = open(os.path.join(self.path, name), 'rb')
+        except FileNotFoundError:
+            # Removed behind our back, which is not damage
+            self.misses += 1
+            self.size -= self._entries.pop(name)
+            return None
+        if (os.fstat(fp.fileno()).st_size == size and size >= 3 and
+                TRAILER.endswith(os.pread(fp.fileno(), 5, max(size - 5, 0)))):
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return fp
+        fp.close()
+        log.warning('Discarding damaged spool file %s', name)
+        self.corrupt += 1
+        self.misses += 1
+        self._remove(name)
+        return None
+
+    def _tmp_name(self, name):
+        return '%s.%s.%s.tmp' % (os.path.join(self.path, name), os.getpid(),
+                                 next(self._tmp_names))
+
+    def _write(self, name, body):
+        filename = os.path.join(self.path, name)
+        tmp = self._tmp_name(name)
+        encoder = MultilineEncoder()
+        with open(tmp, 'wb') as fp:
+            for chunk in encoder.feed(body):
+                fp.write(chunk)
+            fp.write(encoder.finish())
+            size = fp.tell()
+        os.replace(tmp, filename)
+        return size
+
+    async def store(self, key, body):
+        'Add the message *body* to the spool. Errors are only logged.'
+        name = self.filename(key)
+        # Dot-stuffing and the terminator make the file slightly larger
+        if name in self._entries or len(body) >= self.max_bytes:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            size = await loop.run_in_executor(None, self._write, name, body)
+        except OSError:
+            log.exception('Could not spool %s', name)
+            return
+        self._add(name, size)
+
+    def writer(self, key, size):
+        '''Return a SpoolWriter to spool the message *key* of *size* bytes
+        while it is streamed, or None if it is spooled or too large.'''
+        name = self.filename(key)
+        if name in self._entries or size >= self.max_bytes:
+            return None
+        return SpoolWriter(self, name)
+
+    def _add(self, name, size):
+        old = self._entries.pop(name, None)
+        if old is not None:
+            self.size -= old
+        self._entries[name] = size
+        self.size += size
+        self.stores += 1
+        self._evict()
+
+    def _remove(self, name):
+        self.size -= self._entries.pop(name)
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            name = next(iter(self._entries))
+            self._remove(name)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(messages=len(self._entries), size=self.size,
+                    hits=self.hits, misses=self.misses, stores=self.stores,
+                    evictions=self.evictions, corrupt=self.corrupt)
+
+
+def _writer_running(tmp_name):
+    # Temporary names end with .PID.N.tmp
+    try:
+        pid = int(tmp_name.split('.')[-3])
+    except (IndexError, ValueError):
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SpoolWriter:
+    '''A message written to the spool piece by piece as it is sent.
+
+    tee() passes the chunks of the message on while writing them to a
+    temporary file. commit() adds the file to the spool if every chunk was
+    written and the file ends with the trailer, and discards it otherwise.
+    Write errors are logged and only stop the spooling.
+    '''
+
+    def __init__(self, spool, name):
+        self.spool = spool
+        self.name = name
+        self._tmp = spool._tmp_name(name)
+        self._fp = None
+        self._encoder = MultilineEncoder()
+        self._failed = False
+        self.complete = False
+
+    def _write_chunks(self, chunks):
+        if self._fp is None:
+            self._fp = open(self._tmp, 'wb')
+        for chunk in chunks:
+            self._fp.write(chunk)
+
+    async def _write(self, chunks):
+        if self._failed:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write_chunks, chunks)
+        except OSError:
+            log.exception('Could not spool %s', self.name)
+            self._failed = True
+
+    async def tee(self, chunks):
+        'Yield the chunks of the async iterable *chunks*, spooling them.'
+        async for data in chunks:
+            await self._write(list(self._encoder.feed(data)))
+            yield data
+        self.complete = True
+
+    def _finish(self):
+        self._fp.write(self._encoder.finish())
+        size = self._fp.tell()
+        self._fp.close()
+        self._fp = None
+        with open(self._tmp, 'rb') as fp:
+            if os.pread(fp.fileno(), 5, max(size - 5, 0)) != TRAILER:
+                raise ValueError('no trailer')
+        os.replace(self._tmp, os.path.join(self.spool.path, self.name))
+        return size
+
+    async def commit(self):
+        'Add the message to the spool if all of it was written.'
+        if not self.complete or self._failed or self._fp is None:
+            self.discard()
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            size = await loop.run_in_executor(None, self._finish)
+        except (OSError, ValueError):
+            log.exception('Could not spool %s', self.name)
+            self.discard()
+            return
+        self.spool._add(self.name, size)
+
+    def discard(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        try:
+            os.unlink(self._tmp)
+        except FileNotFoundError:
+            pass
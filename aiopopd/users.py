@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+
+from aiopopd.pop import log
+
+
+SQLITE_HEADER = b'SQLite format 3\0'
+
+
+def _valid(username, config):
+    if not isinstance(config, dict):
+        log.warning('Ignoring user %r: configuration is not an object',
+                    username)
+        return False
+    if 'hostname' not in config or 'port' not in config:
+        log.warning('Ignoring user %r: hostname or port missing', username)
+        return False
+    return True
+
+
+class UserDirectory:
+    '''Account configuration of each POP3 user, kept in memory.
+
+    *path* is one of:
+
+    - a directory with one JSON file per user, named after the user,
+    - a JSON file holding an object that maps usernames to configurations,
+    - an SQLite database with a table users(username TEXT PRIMARY KEY,
+      config TEXT) whose config column holds the JSON configuration.
+
+    A configuration has the keys hostname, port and optionally ssl and
+    username. The source is read when the directory is created, and then
+    in an executor, so logins never wait for file I/O. At most every
+    *check_interval* seconds, a lookup starts a check of the modification
+    times that reloads what changed (only the changed files of a directory);
+    lookups are answered from the users already loaded until it is done.
+    '''
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        if os.path.isdir(path):
+            self.format = 'directory'
+        else:
+            with open(path, 'rb') as fp:
+                header = fp.read(len(SQLITE_HEADER))
+            self.format = 'sqlite' if header == SQLITE_HEADER else 'json'
+        # username -> configuration
+        self._users = {}
+        # What the modification times were when last loaded
+        self._versions = {}
+        self._checked = 0
+        self._refreshing = None
+        self.lookups = self.reloads = 0
+        self._users, self._versions = self._load()
+        self._checked = time.monotonic()
+
+    async def get(self, username):
+        'Return the configuration of *username*, or None.'
+        self.lookups += 1
+        if (self._refreshing is None and
+                time.monotonic() - self._checked > self.check_interval):
+            loop = asyncio.get_event_loop()
+            self._refreshing = loop.run_in_executor(None, self._load)
+            self._refreshing.add_done_callback(self._refreshed)
+        return self._users.get(username)
+
+    def _refreshed(self, future):
+        self._refreshing = None
+        self._checked = time.monotonic()
+        try:
+            users, versions = future.result()
+        except Exception:
+            log.exception('Could not reload users from %s', self.path)
+            return
+        if versions != self._versions:
+            self.reloads += 1
+            log.info('Reloaded %s users from %s', len(users), self.path)
+        self._users, self._versions = users, versions
+
+    def _load(self):
+        # Runs in an executor after startup; only reads self._users and
+        # self._versions, which are replaced rather than changed.
+        if self.format == 'directory':
+            return self._load_directory()
+        if self.format == 'sqlite':
+            # The write-ahead log changes without the database file
+            versions = {suffix: self._mtime(self.path + suffix)
+                        for suffix in ('', '-wal')}
+        else:
+            versions = {'': self._mtime(self.path)}
+        if versions == self._versions:
+            return self._users, versions
+        if self.format == 'sqlite':
+            return self._load_sqlite(), versions
+        with open(self.path) as fp:
+            users = json.load(fp)
+        if not isinstance(users, dict):
+            raise ValueError('%s does not hold a JSON object' % self.path)
+        return {username: config for username, config in users.items()
+                if _valid(username, config)}, versions
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load_directory(self):
+        users = {}
+        versions = {}
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            st = entry.stat()
+            version = versions[entry.name] = st.st_mtime_ns, st.st_size
+            if self._versions.get(entry.name) == version:
+                if entry.name in self._users:
+                    users[entry.name] = self._users[entry.name]
+                continue
+            try:
+                with open(entry.path) as fp:
+                    config = json.load(fp)
+            except (OSError, ValueError) as exn:
+                # Keep the old configuration; the file is read again when
+                # it changes.
+                log.warning('Could not read user %r: %s', entry.name, exn)
+                if entry.name in self._users:
+                    users[entry.name] = self._users[entry.name]
+                continue
+            if _valid(entry.name, config):
+                users[entry.name] = config
+        return users, versions
+
+    def _load_sqlite(self):
+        uri = 'file:%s?mode=ro' % self.path
+        connection = sqlite3.connect(uri, uri=True)
+        try:
+            rows = connection.execute(
+                'SELECT username, config FROM users').fetchall()
+        finally:
+            connection.close()
+        users = {}
+        for username, config in rows:
+            try:
+                config = json.loads(config)
+            except ValueError as exn:
+                log.warning('Ignoring user %r: %s', username, exn)
+                continue
+            if _valid(username, config):
+                users[username] = config
+        return users
+
+    def stats(self):
+        return dict(users=len(self._users), lookups=self.lookups,
+                    reloads=self.reloads)
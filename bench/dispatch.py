@@ -0,0 +1,111 @@
+'''Per-command cost of parsing and dispatching POP3 command lines.
+
+Compares Pop3._handle_line, which uses the class-level dispatch table, with
+the getattr-based dispatch it replaced, and with the table dispatch
+recording command latencies in a Metrics. Responses go to a writer that
+discards them, so only the protocol's own work is measured.
+
+Usage: python bench/dispatch.py [--commands 200000]
+'''
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiopopd.pop import Pop3  # noqa
+from aiopopd.metrics import Metrics  # noqa
+
+
+log = logging.getLogger('aiopopd.log')
+parser = argparse.ArgumentParser()
+parser.add_argument('--commands', type=int, default=200000)
+
+LINES = [b'NOOP\r\n', b'STAT\r\n', b'LIST 1\r\n', b'UIDL 1\r\n',
+         b'noop\r\n', b'XYZZY\r\n']
+
+
+class Handler:
+    async def handle_STAT(self, server):
+        return '+OK 1 100'
+
+    async def handle_LIST(self, server, n):
+        return 100
+
+    async def handle_UIDL(self, server, n):
+        return 'uid'
+
+    def connection_lost(self):
+        pass
+
+
+class NullTransport:
+    def get_write_buffer_size(self):
+        return 0
+
+
+class NullWriter:
+    transport = NullTransport()
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+async def getattr_dispatch(self, line):
+    # The dispatch of _handle_client before the dispatch table
+    log.debug('%s %s', self.peer_str, line.split()[0])
+    line = line.rstrip(b'\r\n')
+    if not line:
+        await self.push('-ERR Error: bad syntax')
+        return
+    line = line.decode('ascii')
+    try:
+        command, arg = line.split(' ', 1)
+    except ValueError:
+        command, arg = line, None
+    method = getattr(self, 'pop3_' + command, None)
+    method_state = getattr(method, 'command_state', None)
+    if method_state is not None and method_state != self.state:
+        await self.push('-ERR wrong state for "%s"' % command)
+        return
+    if method is None:
+        await self.push('-ERR command "%s" not recognized' % command)
+        return
+    await method(arg)
+
+
+async def run(dispatch, pop, count):
+    lines = LINES * (count // len(LINES))
+    start = time.perf_counter()
+    for line in lines:
+        await dispatch(pop, line)
+    return (time.perf_counter() - start) / len(lines)
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pop = Pop3(Handler(), hostname='bench', loop=loop)
+    pop.peer_str = 'bench'
+    pop.state = 'TRANSACTION'
+    pop._writer = NullWriter()
+    for name, dispatch, metrics in (
+            ('getattr', getattr_dispatch, None),
+            ('table', Pop3._handle_line, None),
+            ('metrics', Pop3._handle_line, Metrics())):
+        pop.metrics = metrics
+        per_command = loop.run_until_complete(
+            run(dispatch, pop, args.commands))
+        print('%-8s %7.0f ns/command' % (name, per_command * 1e9))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
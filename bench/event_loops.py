@@ -0,0 +1,125 @@
+'''Connections/sec and RETR throughput under each event loop and profile.
+
+The POP3 server runs in a subprocess with the given --loop and --profile
+and an in-memory handler, so no IMAP is involved. The client always uses
+the standard asyncio loop. Loops that are not installed are skipped.
+
+Usage: python bench/event_loops.py [--connections 5000] [--retr-mb 500]
+'''
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiopopd.pop import Pop3  # noqa
+from aiopopd.controller import (  # noqa
+    LOOPS, PROFILES, new_event_loop, configure_loop)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--connections', type=int, default=5000)
+parser.add_argument('--concurrency', type=int, default=100)
+parser.add_argument('--retr-mb', type=int, default=500)
+parser.add_argument('--message-kb', type=int, default=1024)
+parser.add_argument('--serve', nargs=2, metavar=('LOOP', 'PROFILE'),
+                    help=argparse.SUPPRESS)
+
+
+class MemoryHandler:
+    def __init__(self, body):
+        self.body = body
+
+    async def handle_RETR(self, server, n):
+        await server.push_multi('+OK message follows', self.body)
+
+    def connection_lost(self):
+        pass
+
+
+def serve(name, profile, message_size):
+    loop = new_event_loop(name)
+    asyncio.set_event_loop(loop)
+    configure_loop(loop, profile)
+    line = b'x' * 78 + b'\r\n'
+    body = line * (message_size // len(line))
+    server = loop.run_until_complete(loop.create_server(
+        lambda: Pop3(MemoryHandler(body), hostname='bench'), '127.0.0.1', 0))
+    print(server.sockets[0].getsockname()[1], flush=True)
+    # Serve until the benchmark closes our stdin
+    loop.run_until_complete(loop.run_in_executor(None, sys.stdin.read))
+
+
+async def connect_quit(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    await reader.readline()
+    writer.write(b'QUIT\r\n')
+    await reader.readline()
+    writer.close()
+
+
+async def connections(port, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await connect_quit(port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(count)])
+    return count / (time.perf_counter() - start)
+
+
+async def retr(port, total, message_size):
+    reader, writer = await asyncio.open_connection(
+        '127.0.0.1', port, limit=2 * message_size)
+    await reader.readline()
+    writer.write(b'USER bench\r\nPASS bench\r\n')
+    await reader.readline()
+    await reader.readline()
+    count = max(1, total // message_size)
+    received = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        writer.write(b'RETR 1\r\n')
+        received += len(await reader.readuntil(b'\r\n.\r\n'))
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return received / elapsed / 1e6
+
+
+def main():
+    args = parser.parse_args()
+    message_size = args.message_kb * 1024
+    if args.serve:
+        serve(args.serve[0], args.serve[1], message_size)
+        return
+    for name in LOOPS:
+        try:
+            new_event_loop(name).close()
+        except ValueError as exn:
+            print('%-8s skipped: %s' % (name, exn))
+            continue
+        for profile in PROFILES:
+            server = subprocess.Popen(
+                [sys.executable, __file__, '--serve', name, profile,
+                 '--message-kb', str(args.message_kb)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            port = int(server.stdout.readline())
+            loop = asyncio.new_event_loop()
+            rate = loop.run_until_complete(
+                connections(port, args.connections, args.concurrency))
+            throughput = loop.run_until_complete(
+                retr(port, args.retr_mb * 1000000, message_size))
+            loop.close()
+            server.stdin.close()
+            server.wait()
+            print('%-8s %-10s %8.0f connections/s  RETR %7.1f MB/s' % (
+                name, profile, rate, throughput))
+
+
+if __name__ == '__main__':
+    main()
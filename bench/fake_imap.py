@@ -0,0 +1,272 @@
+'''Minimal in-process IMAP server for benchmarks.
+
+Serves one INBOX of synthetic messages to any username and password,
+except the password in FakeImapServer.bad_password. Only the commands that
+aiopopd issues are implemented. With qresync=True, the server also
+advertises ENABLE, CONDSTORE and QRESYNC.
+'''
+import re
+import asyncio
+
+
+_ITEM = re.compile(r'(BODY(?:\.PEEK)?\[([A-Z.]*)\](?:<(\d+)\.(\d+)>)?|[A-Z0-9.]+)')
+_CHANGEDSINCE = re.compile(r'CHANGEDSINCE (\d+)')
+
+
+def make_body(uid, size):
+    header = ('From: bench@example.com\r\nSubject: Message %d\r\n'
+              'Message-ID: <%d@example.com>\r\n\r\n' % (uid, uid)).encode()
+    line = b'x' * 74 + b'\r\n'
+    n = max(0, size - len(header)) // len(line) + 1
+    return header + line * n
+
+
+class Mailbox:
+    def __init__(self, n_messages, size=4096, seen_ratio=0.0):
+        self.uidvalidity = 1
+        self.uids = list(range(1, n_messages + 1))
+        self.seen = set(self.uids[:int(n_messages * seen_ratio)])
+        self.size = size
+        self._bodies = {}
+        # uid -> MODSEQ of its last change, and (MODSEQ, uid) of expunges
+        self.highestmodseq = 1
+        self.modseqs = dict.fromkeys(self.uids, 1)
+        self.vanished = []
+
+    def touch(self, uid):
+        self.highestmodseq += 1
+        self.modseqs[uid] = self.highestmodseq
+
+    @property
+    def uidnext(self):
+        return (self.uids[-1] + 1) if self.uids else 1
+
+    def body(self, uid):
+        try:
+            return self._bodies[uid]
+        except KeyError:
+            b = self._bodies[uid] = make_body(uid, self.size)
+            return b
+
+    def parse_set(self, s):
+        result = set()
+        present = set(self.uids)
+        top = self.uids[-1] if self.uids else 0
+        for part in s.split(','):
+            lo, _, hi = part.partition(':')
+            lo = top if lo == '*' else int(lo)
+            hi = lo if not hi else (top if hi == '*' else int(hi))
+            lo, hi = min(lo, hi), max(lo, hi)
+            result.update(u for u in range(lo, hi + 1) if u in present)
+        return sorted(result)
+
+
+class FakeImapServer:
+    # LOGIN with this password fails
+    bad_password = 'bad'
+
+    def __init__(self, mailbox, qresync=False):
+        self.mailbox = mailbox
+        self.qresync = qresync
+        self.capabilities = b'IMAP4rev1 IDLE UIDPLUS' + (
+            b' ENABLE CONDSTORE QRESYNC' if qresync else b'')
+        self.connections = 0
+        self.commands = 0
+        self.logins = 0
+        self.idlers = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._client, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    def close(self):
+        self.server.close()
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        writer.write(b'* OK [CAPABILITY %s] ready\r\n' % self.capabilities)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip('\r\n')
+                m = re.search(r'\{(\d+)\+?\}$', line)
+                while m:
+                    writer.write(b'+ go\r\n')
+                    lit = await reader.readexactly(int(m.group(1)))
+                    rest = (await reader.readline()).decode().rstrip('\r\n')
+                    line = line[:m.start()] + '"%s"' % lit.decode() + rest
+                    m = re.search(r'\{(\d+)\+?\}$', line)
+                self.commands += 1
+                tag, _, rest = line.partition(' ')
+                cmd, _, args = rest.partition(' ')
+                cmd = cmd.upper()
+                if cmd == 'UID':
+                    cmd, _, args = args.partition(' ')
+                    cmd = cmd.upper()
+                handler = getattr(self, 'do_' + cmd, None)
+                if handler is None:
+                    writer.write(('%s BAD unknown command\r\n' % tag).encode())
+                    continue
+                status = await handler(reader, writer, tag, args)
+                writer.write(('%s %s\r\n' % (tag, status)).encode())
+                await writer.drain()
+                if cmd == 'LOGOUT':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def do_CAPABILITY(self, reader, writer, tag, args):
+        writer.write(b'* CAPABILITY %s\r\n' % self.capabilities)
+        return 'OK CAPABILITY completed'
+
+    async def do_ENABLE(self, reader, writer, tag, args):
+        if self.qresync:
+            enabled = [c for c in args.upper().split()
+                       if c in ('CONDSTORE', 'QRESYNC')]
+            writer.write(('* ENABLED %s\r\n' % ' '.join(enabled)).encode())
+        return 'OK ENABLE completed'
+
+    async def do_LOGIN(self, reader, writer, tag, args):
+        self.logins += 1
+        if args.split()[-1].strip('"') == self.bad_password:
+            return 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        return 'OK LOGIN completed'
+
+    async def do_NOOP(self, reader, writer, tag, args):
+        return 'OK NOOP completed'
+
+    async def do_LOGOUT(self, reader, writer, tag, args):
+        writer.write(b'* BYE logging out\r\n')
+        return 'OK LOGOUT completed'
+
+    async def do_SELECT(self, reader, writer, tag, args):
+        mb = self.mailbox
+        writer.write((
+            '* %d EXISTS\r\n* 0 RECENT\r\n'
+            '* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n'
+            '* OK [UIDVALIDITY %d] UIDs valid\r\n'
+            '* OK [UIDNEXT %d] Predicted next UID\r\n' % (
+                len(mb.uids), mb.uidvalidity, mb.uidnext)).encode())
+        if self.qresync:
+            writer.write(b'* OK [HIGHESTMODSEQ %d] Highest\r\n' %
+                         mb.highestmodseq)
+        return 'OK [READ-WRITE] SELECT completed'
+
+    do_EXAMINE = do_SELECT
+
+    async def do_SEARCH(self, reader, writer, tag, args):
+        mb = self.mailbox
+        words = args.upper().split()
+        uids = mb.uids
+        if 'UNSEEN' in words:
+            uids = [u for u in uids if u not in mb.seen]
+        if 'UID' in words:
+            allowed = set(mb.parse_set(words[words.index('UID') + 1]))
+            uids = [u for u in uids if u in allowed]
+        writer.write(('* SEARCH %s\r\n' % ' '.join(map(str, uids))).encode())
+        return 'OK SEARCH completed'
+
+    async def do_FETCH(self, reader, writer, tag, args):
+        mb = self.mailbox
+        msgset, _, items = args.partition(' ')
+        items = items.strip()
+        modifiers = ''
+        if items.startswith('('):
+            end = items.index(')', items.rfind(']') + 1)
+            items, modifiers = items[1:end], items[end + 1:].upper()
+        items = [m.group(0) for m in _ITEM.finditer(items.upper())]
+        changedsince = _CHANGEDSINCE.search(modifiers)
+        uids = mb.parse_set(msgset)
+        if changedsince:
+            since = int(changedsince.group(1))
+            if 'VANISHED' in modifiers:
+                gone = [uid for modseq, uid in mb.vanished if modseq > since]
+                if gone:
+                    writer.write(('* VANISHED (EARLIER) %s\r\n' % ','.join(
+                        map(str, gone))).encode())
+            uids = [uid for uid in uids if mb.modseqs[uid] > since]
+        seqs = {u: i for i, u in enumerate(mb.uids, 1)}
+        for uid in uids:
+            parts = [b'UID %d' % uid]
+            if changedsince:
+                parts.append(b'MODSEQ (%d)' % mb.modseqs[uid])
+            for item in items:
+                m = _ITEM.match(item)
+                body = mb.body(uid)
+                if item == 'FLAGS':
+                    parts.append(b'FLAGS (\\Seen)' if uid in mb.seen
+                                 else b'FLAGS ()')
+                elif item == 'RFC822.SIZE':
+                    parts.append(b'RFC822.SIZE %d' % len(body))
+                elif item == 'RFC822':
+                    parts.append(b'RFC822 {%d}\r\n' % len(body) + body)
+                elif m.group(2) is not None:
+                    section = m.group(2)
+                    head, _, text = body.partition(b'\r\n\r\n')
+                    data = {'': body, 'HEADER': head + b'\r\n\r\n',
+                            'TEXT': text}[section]
+                    key = 'BODY[%s]' % section
+                    if m.group(3) is not None:
+                        start, length = int(m.group(3)), int(m.group(4))
+                        data = data[start:start + length]
+                        key += '<%s>' % start
+                    parts.append(key.encode() + b' {%d}\r\n' % len(data) + data)
+            writer.write(b'* %d FETCH (%s)\r\n' % (seqs[uid], b' '.join(parts)))
+            if writer.transport.get_write_buffer_size() > 1 << 20:
+                await writer.drain()
+        return 'OK FETCH completed'
+
+    async def do_STORE(self, reader, writer, tag, args):
+        mb = self.mailbox
+        msgset, _, rest = args.partition(' ')
+        if '\\SEEN' in rest.upper():
+            for uid in mb.parse_set(msgset):
+                if rest.startswith('-'):
+                    mb.seen.discard(uid)
+                else:
+                    mb.seen.add(uid)
+                mb.touch(uid)
+        return 'OK STORE completed'
+
+    async def do_IDLE(self, reader, writer, tag, args):
+        writer.write(b'+ idling\r\n')
+        await writer.drain()
+        self.idlers.add(writer)
+        try:
+            await reader.readline()
+        finally:
+            self.idlers.discard(writer)
+        return 'OK IDLE terminated'
+
+    def _notify(self, line):
+        for writer in self.idlers:
+            writer.write(line)
+
+    def deliver(self):
+        'Add a message to the mailbox and tell idling clients.'
+        mb = self.mailbox
+        mb.uids.append(mb.uidnext)
+        mb.touch(mb.uids[-1])
+        self._notify(b'* %d EXISTS\r\n' % len(mb.uids))
+
+    def expunge(self, uid):
+        mb = self.mailbox
+        n = mb.uids.index(uid) + 1
+        mb.uids.remove(uid)
+        mb.seen.discard(uid)
+        del mb.modseqs[uid]
+        mb.highestmodseq += 1
+        mb.vanished.append((mb.highestmodseq, uid))
+        self._notify(b'* %d EXPUNGE\r\n' % n)
+
+    def mark_seen(self, uid):
+        mb = self.mailbox
+        mb.seen.add(uid)
+        mb.touch(uid)
+        self._notify(b'* %d FETCH (FLAGS (\\Seen))\r\n' %
+                     (mb.uids.index(uid) + 1))
@@ -0,0 +1,105 @@
+'''Compare the threaded and the asyncio IMAP backends.
+
+Runs many concurrent POP3-style login sessions (connect, LOGIN, SELECT,
+SEARCH, FETCH FLAGS RFC822.SIZE, LOGOUT) against an in-process fake IMAP
+server and reports sessions/sec, peak thread count and peak RSS. Each
+backend runs in a fresh subprocess; "pool" is the threaded backend sharing
+an ImapWorkerPool.
+
+Usage: python bench/imap_backends.py [--sessions 2000] [--concurrency 300]
+'''
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import functools
+import threading
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiopopd.imap import BACKENDS  # noqa
+from aiopopd.imap_backend import ImapBackend, ImapWorkerPool  # noqa
+from fake_imap import Mailbox, FakeImapServer  # noqa
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sessions', type=int, default=2000)
+parser.add_argument('--concurrency', type=int, default=300)
+parser.add_argument('--messages', type=int, default=200)
+parser.add_argument('--backend', choices=sorted(BACKENDS) + ['pool'])
+parser.add_argument('--workers', type=int, default=16,
+                    help='Number of threads for the pool backend')
+parser.add_argument('--trace-memory', action='store_true',
+                    help='Also report peak traced Python memory (slow)')
+
+
+async def session(loop, backend_class, port):
+    backend = backend_class(loop=loop, host='127.0.0.1', port=port, ssl=False)
+    await backend.connect()
+    await backend.login('user', 'password')
+    await backend.select_folder('INBOX')
+    uids = await backend.search()
+    await backend.fetch(uids, ['FLAGS', 'RFC822.SIZE'])
+    await backend.disconnect()
+
+
+async def run(loop, backend_class, args):
+    server = FakeImapServer(Mailbox(args.messages))
+    port = await server.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    peak_threads = [threading.active_count()]
+
+    async def one():
+        async with semaphore:
+            await session(loop, backend_class, port)
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(args.sessions)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    return elapsed, peak_threads[0]
+
+
+def run_backend(args):
+    loop = asyncio.get_event_loop()
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.backend == 'pool':
+        backend_class = functools.partial(
+            ImapBackend, executor=ImapWorkerPool(args.workers))
+    else:
+        backend_class = BACKENDS[args.backend]
+    elapsed, threads = loop.run_until_complete(
+        run(loop, backend_class, args))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    line = '%-8s %8.1f sessions/s  peak threads %4d  max RSS %7.1f MB' % (
+        args.backend, args.sessions / elapsed, threads, rss / 1e3)
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        line += '  peak traced %7.1f MB' % (peak / 1e6)
+    print(line)
+
+
+def main():
+    args = parser.parse_args()
+    if args.backend:
+        run_backend(args)
+        return
+    for backend in sorted(BACKENDS) + ['pool']:
+        subprocess.check_call(
+            [sys.executable, __file__, '--backend', backend,
+             '--workers', str(args.workers),
+             '--sessions', str(args.sessions),
+             '--concurrency', str(args.concurrency),
+             '--messages', str(args.messages)] +
+            (['--trace-memory'] if args.trace_memory else []))
+
+
+if __name__ == '__main__':
+    main()
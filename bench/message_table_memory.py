@@ -0,0 +1,81 @@
+'''Memory per session of a list of message objects versus MessageTable.
+
+Usage: python bench/message_table_memory.py [--counts 10000 100000 1000000]
+'''
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiopopd.messages import MessageTable  # noqa
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--counts', type=int, nargs='+',
+                    default=[10000, 100000, 1000000])
+
+
+class Message:
+    # The per-message object ImapHandler used before MessageTable
+    def __init__(self, uid, deleted, size):
+        self.uid = uid
+        self.deleted = deleted
+        self.size = size
+
+
+def rows(count):
+    # Fresh int objects for every message, as when parsing a FETCH response
+    return ((100000 + i, 2000 + i % 100000) for i in range(count))
+
+
+def build_list(count):
+    return [Message(uid, False, size) for uid, size in rows(count)]
+
+
+def stat_list(messages):
+    n = sum(1 for m in messages if not m.deleted)
+    size = sum(m.size for m in messages if not m.deleted)
+    return n, size
+
+
+def build_table(count):
+    uids = []
+    sizes = []
+    for uid, size in rows(count):
+        uids.append(uid)
+        sizes.append(size)
+    return MessageTable(uids, sizes)
+
+
+def stat_table(table):
+    return table.count, table.octets
+
+
+def measure(build, stat, count):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    messages = build(count)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(10):
+        stat(messages)
+    return used, (time.perf_counter() - start) / 10
+
+
+def main():
+    args = parser.parse_args()
+    for count in args.counts:
+        for name, build, stat in (('list', build_list, stat_list),
+                                  ('table', build_table, stat_table)):
+            used, stat_time = measure(build, stat, count)
+            print('%8d messages  %-5s %9.2f MB  %6.1f B/message  '
+                  'STAT %9.3f ms' % (count, name, used / 1e6, used / count,
+                                     stat_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''Compare RETR throughput of the per-line writer and MultilineEncoder.
+
+Each round sends one synthetic message through an asyncio StreamWriter over
+a local socket pair while the other end reads until the terminating ".".
+
+Usage: python bench/retr_throughput.py [--size-mb 20] [--rounds 5]
+'''
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiopopd.encoder import MultilineEncoder  # noqa
+from aiopopd.pop import DRAIN_THRESHOLD  # noqa
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size-mb', type=float, default=20)
+parser.add_argument('--rounds', type=int, default=5)
+parser.add_argument('--bare-lf', action='store_true',
+                    help='Use LF line endings as some IMAP servers do')
+
+
+def make_message(size, newline):
+    rng = random.Random(42)
+    alphabet = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+    line = bytes(rng.choice(alphabet) for _ in range(76))
+    lines = []
+    total = 0
+    while total < size:
+        # Sprinkle in lines that need dot-stuffing
+        lines.append(b'.' + line[1:] if rng.random() < 0.01 else line)
+        total += len(line) + len(newline)
+    return newline.join(lines) + newline
+
+
+async def per_line(writer, data):
+    for line in data.split(b'\r\n'):
+        if line.startswith(b'.'):
+            line = b'.' + line
+        writer.write(line + b'\r\n')
+        await writer.drain()
+    writer.write(b'.\r\n')
+    await writer.drain()
+
+
+async def encoder(writer, data):
+    enc = MultilineEncoder()
+    for chunk in enc.feed(data):
+        writer.write(chunk)
+        if writer.transport.get_write_buffer_size() >= DRAIN_THRESHOLD:
+            await writer.drain()
+    writer.write(enc.finish())
+    await writer.drain()
+
+
+async def consume(loop, sock):
+    tail = b''
+    received = 0
+    while not tail.endswith(b'\r\n.\r\n'):
+        data = await loop.sock_recv(sock, 256 * 1024)
+        if not data:
+            break
+        received += len(data)
+        tail = (tail + data)[-5:]
+    return received
+
+
+async def run_once(loop, send, data):
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    reader, writer = await asyncio.open_connection(sock=a)
+    start = time.perf_counter()
+    sent, received = await asyncio.gather(
+        send(writer, data), consume(loop, b))
+    elapsed = time.perf_counter() - start
+    writer.close()
+    b.close()
+    return received, elapsed
+
+
+def main():
+    args = parser.parse_args()
+    newline = b'\n' if args.bare_lf else b'\r\n'
+    data = make_message(int(args.size_mb * 1024 * 1024), newline)
+    loop = asyncio.get_event_loop()
+    for name, send in (('per-line', per_line), ('encoder', encoder)):
+        if name == 'per-line' and args.bare_lf:
+            # The per-line writer cannot handle bare LF bodies correctly
+            continue
+        best = None
+        for _ in range(args.rounds):
+            received, elapsed = loop.run_until_complete(
+                run_once(loop, send, data))
+            best = elapsed if best is None else min(best, elapsed)
+        print('%-9s %8.1f MB/s  (%s bytes in %.3f s)' % (
+            name, len(data) / best / 1e6, received, best))
+
+
+if __name__ == '__main__':
+    main()
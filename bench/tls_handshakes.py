@@ -0,0 +1,95 @@
+'''TLS handshakes per second, full and resumed, for RSA and ECDSA keys.
+
+Generates a certificate of each key type with get_ssl_context, serves POP3
+with it from a Controller thread, and connects sequentially, reading the
+greeting and sending QUIT. "full" connects without a session; "resumed"
+offers the session of the previous connection. The server's own counts
+of full and resumed handshakes are printed to check that resumption
+happened.
+
+Usage: python bench/tls_handshakes.py [--connections 300]
+'''
+import os
+import sys
+import ssl
+import time
+import socket
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiopopd.pop import Pop3  # noqa
+from aiopopd.main import get_ssl_context, KEY_TYPES  # noqa
+from aiopopd.controller import Controller  # noqa
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--connections', type=int, default=300)
+parser.add_argument('--tickets', type=int, default=2)
+parser.add_argument('--tls', choices=('1.2', '1.3'), default='1.3')
+
+
+class Handler:
+    def connection_lost(self):
+        pass
+
+
+def connect(client_context, port, session):
+    with socket.create_connection(('127.0.0.1', port)) as raw:
+        with client_context.wrap_socket(raw, session=session) as sock:
+            fp = sock.makefile('rb')
+            fp.readline()
+            sock.sendall(b'QUIT\r\n')
+            fp.readline()
+            fp.close()
+            # TLS 1.3 tickets arrive after the handshake, with the greeting
+            return sock.session
+
+
+def run(client_context, port, count, resume):
+    session = None
+    start = time.perf_counter()
+    for _ in range(count):
+        new_session = connect(client_context, port, session)
+        if resume:
+            session = new_session
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    version = dict(zip(('1.2', '1.3'), (ssl.TLSVersion.TLSv1_2,
+                                        ssl.TLSVersion.TLSv1_3)))[args.tls]
+    client_context.minimum_version = client_context.maximum_version = version
+    with tempfile.TemporaryDirectory() as tmp:
+        for key_type in sorted(KEY_TYPES):
+            options = argparse.Namespace(
+                ssl_key=os.path.join(tmp, key_type + '.key'),
+                ssl_cert=os.path.join(tmp, key_type + '.crt'),
+                ssl_generate=True, ssl_key_type=key_type,
+                ssl_tickets=args.tickets)
+            context = get_ssl_context(options)
+            controller = Controller(Handler(), hostname='127.0.0.1', port=0,
+                                    ssl_context=context)
+            controller.factory = lambda: Pop3(Handler(), hostname='bench')
+            controller.start()
+            port = controller.server.sockets[0].getsockname()[1]
+            for mode in ('full', 'resumed'):
+                before = Pop3.stats()
+                rate = run(client_context, port, args.connections,
+                           mode == 'resumed')
+                after = Pop3.stats()
+                print('%-6s %-8s %7.0f handshakes/s  '
+                      '(server: %s full, %s resumed)' % (
+                          key_type, mode, rate,
+                          after['tls_full'] - before['tls_full'],
+                          after['tls_resumed'] - before['tls_resumed']))
+            controller.stop()
+
+
+if __name__ == '__main__':
+    main()